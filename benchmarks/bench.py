@@ -0,0 +1,204 @@
+"""Offline throughput benchmark for jukebox-fm
+
+Runs station, friends, loved and album modes, plus station mode on the
+--asyncio engine, against a fake MPD server, a local Last.fm stand-in and
+a stub yt-dlp extractor, then reports tracks/sec, time-to-first-queue and
+peak RSS for each mode.
+
+    python benchmarks/bench.py --library-size 150000 --modes station friends
+"""
+
+from argparse import ArgumentParser
+from json import dump
+from os import environ, path, makedirs, urandom, wait4, waitstatus_to_exitcode
+from shutil import which, rmtree
+from subprocess import Popen, DEVNULL, run
+from tempfile import mkdtemp, NamedTemporaryFile
+from threading import Thread
+from time import monotonic
+import sys
+
+sys.path.insert(0, path.dirname(path.abspath(__file__)))
+
+from fake_mpd import FakeMPDServer
+from fake_lastfm import Catalog, FakeLastfmServer
+
+HERE = path.dirname(path.abspath(__file__))
+MODES = ("station", "friends", "loved", "album", "asyncio")
+
+CONFIG = """\
+[music]
+music_folder = "{music_folder}"
+
+[lastfm]
+username = "bench"
+mode = "mix"
+API_KEY = "bench"
+loved_tracks_limit = 0
+max_tracks = {station_size}
+max_albums = {albums}
+
+[yt_dlp]
+quiet = true
+noplaylist = true
+geo_bypass = true
+preferred_quality = "192"
+format = "opus/bestaudio"
+outtmpl = "%(artist)s - %(title)s"
+postprocess = "fast"
+audio_codec = "opus"
+cookies = ""
+
+[download]
+workers = {workers}
+
+[friends]
+friends_file = "{friends_file}"
+
+[logging]
+log_file = "{log_file}"
+"""
+
+
+def parse_arguments():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=list(MODES))
+    parser.add_argument("--library-size", type=int, default=150000)
+    parser.add_argument("--station-size", type=int, default=50)
+    parser.add_argument("--hit-ratio", type=float, default=0.5)
+    parser.add_argument("--friends", type=int, default=40)
+    parser.add_argument("--loved", type=int, default=500)
+    parser.add_argument("--albums", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--audio-seconds", type=int, default=3)
+    parser.add_argument("--json", help="Also write the results to this file")
+    parser.add_argument(
+        "--verbose", action="store_true", help="Show jukebox-fm's output"
+    )
+    return parser.parse_args()
+
+
+def synthetic_audio(seconds):
+    """A short opus file, or random bytes when ffmpeg isn't installed"""
+    if not which("ffmpeg"):
+        return urandom(seconds * 24000), False
+    with NamedTemporaryFile(suffix=".opus") as f:
+        run(
+            [
+                "ffmpeg", "-y", "-loglevel", "error",
+                "-f", "lavfi", "-i", f"sine=frequency=440:duration={seconds}",
+                "-c:a", "libopus", f.name,
+            ],
+            check=True,
+        )
+        return f.read(), True
+
+
+def mode_arguments(mode, home):
+    if mode == "station":
+        return ["-u", "bench"]
+    if mode == "friends":
+        return ["-f", path.join(home, ".config/jukebox-fm/friends.txt")]
+    if mode == "loved":
+        return ["-o", "-u", "bench"]
+    if mode == "asyncio":
+        return ["--asyncio", "-u", "bench"]
+    return ["-b", "Bench Artist", "-d"]
+
+
+def serve(server):
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def run_mode(mode, args, audio, ffmpeg):
+    home = mkdtemp(prefix=f"jukebox-bench-{mode}-")
+    config_dir = path.join(home, ".config/jukebox-fm")
+    music_dir = path.join(home, "Music")
+    makedirs(config_dir)
+    makedirs(path.join(music_dir, "dl"))
+
+    with open(path.join(config_dir, "friends.txt"), "w") as f:
+        f.writelines(f"friend{i}\n" for i in range(args.friends))
+    with open(path.join(config_dir, "config.toml"), "w") as f:
+        f.write(
+            CONFIG.format(
+                music_folder=path.join(music_dir, "dl"),
+                station_size=args.station_size,
+                albums=args.albums,
+                workers=args.workers,
+                friends_file=path.join(config_dir, "friends.txt"),
+                log_file=path.join(home, "jukebox-fm.log"),
+            )
+        )
+
+    catalog = Catalog(
+        args.library_size, args.station_size, args.hit_ratio, args.loved, args.albums
+    )
+    mpd = serve(FakeMPDServer(music_dir, args.library_size))
+    lastfm = serve(FakeLastfmServer(catalog, audio))
+    env = {
+        **environ,
+        "HOME": home,
+        "BENCH_MPD_PORT": str(mpd.server_address[1]),
+        "BENCH_LASTFM_URL": lastfm.url,
+    }
+    if not ffmpeg:
+        env["BENCH_NO_FFMPEG"] = "1"
+
+    output = None if args.verbose else DEVNULL
+    start = monotonic()
+    child = Popen(
+        [sys.executable, path.join(HERE, "run_mode.py"), *mode_arguments(mode, home), "--no-cache"],
+        env=env,
+        stdout=output,
+        stderr=output,
+    )
+    _, status, rusage = wait4(child.pid, 0)
+    elapsed = monotonic() - start
+
+    state = mpd.mpd
+    result = {
+        "mode": mode,
+        "exit_code": waitstatus_to_exitcode(status),
+        "seconds": round(elapsed, 3),
+        "queued": state.adds,
+        "tracks_per_sec": round(state.adds / elapsed, 2) if elapsed else 0,
+        "first_queue_sec": round(state.first_add - start, 3) if state.first_add else None,
+        "db_updates": state.updates,
+        "peak_rss_mb": round(rusage.ru_maxrss / 1024, 1),
+    }
+    mpd.shutdown()
+    lastfm.shutdown()
+    rmtree(home, ignore_errors=True)
+    return result
+
+
+def print_table(results):
+    columns = (
+        "mode", "queued", "seconds", "tracks_per_sec",
+        "first_queue_sec", "db_updates", "peak_rss_mb", "exit_code",
+    )
+    rows = [[str(result[c]) for c in columns] for result in results]
+    widths = [max(len(c), *(len(row[i]) for row in rows)) for i, c in enumerate(columns)]
+    print("  ".join(c.ljust(w) for c, w in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(v.ljust(w) for v, w in zip(row, widths)))
+
+
+def main():
+    args = parse_arguments()
+    audio, ffmpeg = synthetic_audio(args.audio_seconds)
+    if not ffmpeg:
+        print("ffmpeg not found, postprocessing is skipped", file=sys.stderr)
+
+    results = [run_mode(mode, args, audio, ffmpeg) for mode in args.modes]
+    print_table(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
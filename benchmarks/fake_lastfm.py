@@ -0,0 +1,118 @@
+"""Local stand-in for the Last.fm station player, the Last.fm API and
+the audio files the stub yt-dlp extractor downloads"""
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from json import dumps
+from random import Random
+from urllib.parse import urlparse, parse_qs
+
+from fake_mpd import library_artist, library_title
+
+
+def remote_track(n):
+    return f"Remote Artist {n // 5}", f"Remote Title {n}", f"bench{n:07d}"
+
+
+class Catalog:
+    """Deterministic track lists for every endpoint
+
+    Tracks are drawn from a shared pool so friends' stations overlap, and
+    hit_ratio of them exist in the fake MPD library.
+    """
+
+    def __init__(self, library_size, station_size, hit_ratio, loved_size, albums):
+        self.library_size = library_size
+        self.station_size = station_size
+        self.hit_ratio = hit_ratio
+        self.loved_size = loved_size
+        self.albums = albums
+
+    def track(self, rng):
+        if self.library_size and rng.random() < self.hit_ratio:
+            i = rng.randrange(self.library_size)
+            return library_artist(i), library_title(i), f"lib{i:07d}"
+        return remote_track(rng.randrange(self.station_size * 4))
+
+    def station(self, endpoint):
+        rng = Random(endpoint)
+        playlist = []
+        for _ in range(self.station_size):
+            artist, title, playlink_id = self.track(rng)
+            playlist.append(
+                {
+                    "name": title,
+                    "artists": [{"name": artist}],
+                    "_playlinks": [{"id": playlink_id}],
+                }
+            )
+        return {"playlist": playlist}
+
+    def top_albums(self, artist):
+        return {
+            "topalbums": {
+                "album": [{"name": f"{artist} Album {i}"} for i in range(self.albums)]
+            }
+        }
+
+    def loved_tracks(self, user, page, limit):
+        rng = Random(f"loved/{user}")
+        tracks = [self.track(rng) for _ in range(self.loved_size)]
+        chunk = tracks[(page - 1) * limit : page * limit]
+        return {
+            "lovedtracks": {
+                "track": [
+                    {"name": title, "artist": {"name": artist}}
+                    for artist, title, _ in chunk
+                ],
+                "@attr": {
+                    "page": str(page),
+                    "totalPages": str(-(-self.loved_size // limit)),
+                    "total": str(self.loved_size),
+                },
+            }
+        }
+
+
+class LastfmHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def send(self, body, content_type="application/json"):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        catalog = self.server.catalog
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+
+        if url.path.startswith("/player/station/"):
+            endpoint = url.path[len("/player/station/") :]
+            self.send(dumps(catalog.station(endpoint)).encode())
+        elif url.path == "/2.0/" and query.get("method") == "artist.gettopalbums":
+            self.send(dumps(catalog.top_albums(query["artist"])).encode())
+        elif url.path == "/2.0/" and query.get("method") == "user.getlovedtracks":
+            data = catalog.loved_tracks(
+                query["user"], int(query.get("page", 1)), int(query.get("limit", 50))
+            )
+            self.send(dumps(data).encode())
+        elif url.path.startswith("/audio/"):
+            self.send(self.server.audio, "audio/ogg")
+        else:
+            self.send_error(404)
+
+
+class FakeLastfmServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, catalog, audio, port=0):
+        super().__init__(("127.0.0.1", port), LastfmHandler)
+        self.catalog = catalog
+        self.audio = audio
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
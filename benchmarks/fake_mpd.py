@@ -0,0 +1,317 @@
+"""Minimal MPD protocol server for benchmarks
+
+Implements the subset of the protocol jukebox-fm talks: library listing,
+database updates, the queue, command lists and idle. The library is
+synthetic, plus whatever files appear under dl/ in the music directory.
+"""
+
+from os import path, listdir
+from select import select
+from shlex import split
+from socketserver import ThreadingTCPServer, StreamRequestHandler
+from threading import Lock
+from time import monotonic, time
+
+# How often a connection in idle checks for changes and for noidle
+IDLE_POLL_SECONDS = 0.02
+
+
+def library_artist(i):
+    return f"Library Artist {i // 10}"
+
+
+def library_title(i):
+    return f"Library Title {i}"
+
+
+class CommandFailed(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+
+class FakeMPD:
+    """State shared by every connection to the fake server"""
+
+    def __init__(self, music_dir, library_size):
+        self.music_dir = music_dir
+        self.lock = Lock()
+        self.library = {
+            f"lib/{library_artist(i)}/{library_title(i)}.flac": (
+                library_artist(i),
+                library_title(i),
+            )
+            for i in range(library_size)
+        }
+        self.db_update = int(time())
+        self.job = 0
+        self.playlist = []
+        self.next_id = 1
+        # Subsystems changed since each connection's last idle, as real MPD
+        # reports changes that happened before idle was sent
+        self.clients = []
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.playlist.clear()
+            self.first_add = None
+            self.adds = 0
+            self.updates = 0
+
+    def scan_downloads(self):
+        dl_dir = path.join(self.music_dir, "dl")
+        if not path.isdir(dl_dir):
+            return
+        for name in listdir(dl_dir):
+            if name.endswith(".part") or name.endswith(".temp.opus"):
+                continue
+            stem = path.splitext(name)[0]
+            artist, _, title = stem.partition(" - ")
+            self.library.setdefault(f"dl/{name}", (artist, title))
+
+    def changed(self, *subsystems):
+        for events in self.clients:
+            events.update(subsystems)
+
+    def take_events(self, events, subsystems):
+        """Pop the changes a connection idling on subsystems is told about"""
+        with self.lock:
+            found = sorted(events & subsystems if subsystems else events)
+            events.difference_update(found)
+            return found
+
+    def songs(self, uri=""):
+        prefix = f"{uri.rstrip('/')}/" if uri else ""
+        for file_path, (artist, title) in self.library.items():
+            if file_path.startswith(prefix):
+                yield file_path, artist, title
+
+    def run(self, command, args):
+        """Run one command and return its response lines (without OK)"""
+        handler = getattr(self, f"cmd_{command}", None)
+        if handler is None:
+            raise CommandFailed(5, f'unknown command "{command}"')
+        with self.lock:
+            return handler(*args)
+
+    def song_lines(self, file_path, artist, title):
+        return [f"file: {file_path}", f"Artist: {artist}", f"Title: {title}"]
+
+    def cmd_ping(self):
+        return []
+
+    def cmd_listallinfo(self, uri=""):
+        lines = []
+        for song in self.songs(uri):
+            lines.extend(self.song_lines(*song))
+        if uri and not lines:
+            raise CommandFailed(50, "No such directory")
+        return lines
+
+    def cmd_search(self, tag, needle):
+        return [
+            line
+            for file_path, artist, title in self.songs()
+            if needle.lower() in file_path.lower()
+            for line in self.song_lines(file_path, artist, title)
+        ]
+
+    def cmd_stats(self):
+        return [
+            f"artists: {len({artist for artist, _ in self.library.values()})}",
+            "albums: 0",
+            f"songs: {len(self.library)}",
+            "uptime: 1",
+            "db_playtime: 0",
+            f"db_update: {self.db_update}",
+            "playtime: 0",
+        ]
+
+    def cmd_status(self):
+        return [
+            "volume: 100",
+            "state: stop",
+            f"playlistlength: {len(self.playlist)}",
+        ]
+
+    def cmd_update(self, uri=""):
+        # Updates finish instantly, before the client gets to wait on them
+        self.scan_downloads()
+        self.job += 1
+        self.updates += 1
+        self.db_update = max(self.db_update + 1, int(time()))
+        self.changed("update", "database")
+        return [f"updating_db: {self.job}"]
+
+    def add_to_playlist(self, uri):
+        if uri not in self.library and not uri.startswith("http"):
+            raise CommandFailed(50, "No such directory")
+        song_id = self.next_id
+        self.next_id += 1
+        self.playlist.append((song_id, uri))
+        if self.first_add is None:
+            self.first_add = monotonic()
+        self.adds += 1
+        self.changed("playlist")
+        return song_id
+
+    def cmd_add(self, uri):
+        self.add_to_playlist(uri)
+        return []
+
+    def cmd_addid(self, uri, position=None):
+        song_id = self.add_to_playlist(uri)
+        if position is not None:
+            self.playlist.insert(int(position), self.playlist.pop())
+        return [f"Id: {song_id}"]
+
+    def cmd_deleteid(self, song_id):
+        for i, (entry_id, _) in enumerate(self.playlist):
+            if entry_id == int(song_id):
+                del self.playlist[i]
+                self.changed("playlist")
+                return []
+        raise CommandFailed(50, "No such song")
+
+    def cmd_playlistinfo(self):
+        lines = []
+        for position, (song_id, file_path) in enumerate(self.playlist):
+            lines += [f"file: {file_path}", f"Pos: {position}", f"Id: {song_id}"]
+        return lines
+
+    def cmd_playlistid(self, song_id=None):
+        return [
+            line
+            for position, (entry_id, file_path) in enumerate(self.playlist)
+            if song_id is None or entry_id == int(song_id)
+            for line in (f"file: {file_path}", f"Pos: {position}", f"Id: {entry_id}")
+        ]
+
+    def cmd_currentsong(self):
+        return []
+
+    def cmd_sticker(self, *args):
+        raise CommandFailed(5, "sticker database is disabled")
+
+
+class MPDHandler(StreamRequestHandler):
+    def setup(self):
+        super().setup()
+        self.buffer = b""
+        self.events = set()
+        with self.server.mpd.lock:
+            self.server.mpd.clients.append(self.events)
+
+    def finish(self):
+        with self.server.mpd.lock:
+            self.server.mpd.clients.remove(self.events)
+        super().finish()
+
+    def write(self, text):
+        self.wfile.write(text.encode())
+
+    def read_line(self, timeout=None):
+        """Next line from the client, or None if none came within timeout
+
+        The socket is read directly, so idle can tell whether noidle is
+        waiting without blocking on a buffered reader.
+        """
+        while b"\n" not in self.buffer:
+            if timeout is not None and not select([self.connection], [], [], timeout)[0]:
+                return None
+            data = self.connection.recv(65536)
+            if not data:
+                raise EOFError
+            self.buffer += data
+        line, _, self.buffer = self.buffer.partition(b"\n")
+        return line.decode()
+
+    def idle(self, mpd, subsystems):
+        """Block until one of subsystems changes or the client sends noidle"""
+        while True:
+            changed = mpd.take_events(self.events, subsystems)
+            if changed:
+                break
+            line = self.read_line(timeout=IDLE_POLL_SECONDS)
+            if line is None:
+                continue
+            if line.strip() == "noidle":
+                changed = mpd.take_events(self.events, subsystems)
+                break
+            # Anything else during idle is a protocol error, MPD hangs up
+            raise EOFError
+        self.write("".join(f"changed: {name}\n" for name in changed) + "OK\n")
+
+    def handle(self):
+        mpd = self.server.mpd
+        self.write("OK MPD 0.23.5\n")
+        command_list = None
+        list_ok = False
+
+        while True:
+            try:
+                line = self.read_line()
+            except EOFError:
+                return
+            if not line:
+                continue
+            command, *args = split(line)
+
+            if command == "close":
+                return
+            if command == "idle" and command_list is None:
+                try:
+                    self.idle(mpd, set(args))
+                except EOFError:
+                    return
+                continue
+            if command == "noidle":
+                # Outside idle MPD ignores it and sends nothing back
+                continue
+            if command in ("command_list_begin", "command_list_ok_begin"):
+                command_list = []
+                list_ok = command == "command_list_ok_begin"
+                continue
+            if command == "command_list_end":
+                self.run_list(mpd, command_list, list_ok)
+                command_list = None
+                continue
+            if command_list is not None:
+                command_list.append((command, args))
+                continue
+
+            try:
+                lines = mpd.run(command, args)
+            except CommandFailed as e:
+                self.write(f"ACK [{e.code}@0] {{{command}}} {e}\n")
+                continue
+            except TypeError:
+                self.write(f"ACK [2@0] {{{command}}} wrong number of arguments\n")
+                continue
+            self.write("".join(f"{l}\n" for l in lines) + "OK\n")
+
+    def run_list(self, mpd, commands, list_ok):
+        out = []
+        for position, (command, args) in enumerate(commands):
+            try:
+                lines = mpd.run(command, args)
+            except (CommandFailed, TypeError) as e:
+                code = e.code if isinstance(e, CommandFailed) else 2
+                out.append(f"ACK [{code}@{position}] {{{command}}} {e}\n")
+                self.write("".join(out))
+                return
+            out.extend(f"{l}\n" for l in lines)
+            if list_ok:
+                out.append("list_OK\n")
+        out.append("OK\n")
+        self.write("".join(out))
+
+
+class FakeMPDServer(ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, music_dir, library_size, port=0):
+        super().__init__(("127.0.0.1", port), MPDHandler)
+        self.mpd = FakeMPD(music_dir, library_size)
@@ -0,0 +1,95 @@
+"""Fuzzy matching check for jukebox-fm
+
+Runs known look-alike tracks through the fuzzy index and fails when a
+different recording is matched, a decorated tag of the same recording is
+missed, or building the index over a synthetic library is over budget.
+
+    python benchmarks/fuzzy_check.py --library-size 150000 --budget-ms 1000
+"""
+
+from argparse import ArgumentParser
+from time import perf_counter
+import sys
+
+from jukebox_fm import jukebox
+
+LIBRARY = [
+    ("Pink Floyd", "Another Brick in the Wall, Part 1"),
+    ("Beethoven", "Symphony No. 5"),
+    ("Coldplay", "Yellow"),
+    ("Kanye West", "Runaway"),
+    ("Radiohead", "Creep"),
+    ("Fleetwood Mac", "Dreams"),
+    ("Beyoncé", "Halo"),
+    ("Daft Punk", "Get Lucky"),
+    ("Blur", "Song"),
+    ("The Beatles", "Yesterday"),
+    ("Oasis", "Love Songs"),
+]
+
+# (artist, title, expected match or None)
+CASES = [
+    ("Pink Floyd", "Another Brick in the Wall, Part 2", None),
+    ("Pink Floyd", "Another Brick in the Wall, Pt. 3", None),
+    ("Pink Floyd", "Another Brick in the Wall, Part II", None),
+    ("Beethoven", "Symphony No. 6", None),
+    ("Coldplay", "Yellow (Live Version)", None),
+    ("Coldplay", "Yellow - Live", None),
+    ("Kanye West", "Runaway (Instrumental Version)", None),
+    ("Kanye West", "Runaway (Extended Version)", None),
+    ("Radiohead", "Creep - Acoustic Version", None),
+    ("Blur", "Song (Live, Remastered 2011)", None),
+    ("Blur", "Song - Live at Wembley / Remastered 2011", None),
+    ("Blur", "Song - 2011 Remaster - Live", None),
+    ("Blur", "Song (Acoustic; feat. X)", None),
+    ("The Beatles", "Yesterdays", None),
+    ("Oasis", "Love Song", None),
+    ("Pink Floyd", "Another Brick in the Wall, Part 1 (Remastered 2011)", "Another Brick in the Wall, Part 1"),
+    ("Beethoven", "Symphony No. 5 - 2011 Remaster", "Symphony No. 5"),
+    ("Fleetwood Mac", "Dreams (2004 Remaster)", "Dreams"),
+    ("Beyonce", "Halo", "Halo"),
+    ("Daft Punk", "Get Lucky (feat. Pharrell Williams)", "Get Lucky"),
+    ("Daft Punk", "Get Lucky feat. Pharrell Williams", "Get Lucky"),
+    ("Blur", "Song (2009 Digital Remaster)", "Song"),
+    ("Beatles", "Yesterday - Remastered 2009", "Yesterday"),
+]
+
+
+def song(i, artist, title):
+    return {"file": f"music/{i}.opus", "artist": artist, "title": title}
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--library-size", type=int, default=150000)
+    parser.add_argument("--budget-ms", type=float, default=1000)
+    args = parser.parse_args()
+
+    library = [song(i, artist, title) for i, (artist, title) in enumerate(LIBRARY)]
+    files = {song["file"]: song["title"] for song in library}
+    library += [
+        song(i, f"Artist {i // 12}", f"Track {i % 12} of album {i // 12}")
+        for i in range(len(library), args.library_size)
+    ]
+    entries = jukebox.index_entries(library)
+
+    start = perf_counter()
+    index = jukebox.FuzzyIndex(entries, 0.8)
+    ms = (perf_counter() - start) * 1000
+    print(f"fuzzy index over {len(library)} songs: {ms:.0f} ms (budget {args.budget_ms:.0f} ms)")
+
+    failed = False
+    for artist, title, expected in CASES:
+        match = index.lookup(artist, title)
+        got = files.get(match[0]) if match else None
+        if got != expected:
+            print(f"FAIL: '{artist} - {title}' matched {got!r}, expected {expected!r}")
+            failed = True
+    if ms > args.budget_ms:
+        print("FAIL: over the build budget")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
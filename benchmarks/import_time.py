@@ -0,0 +1,57 @@
+"""Startup budget check for jukebox-fm
+
+Imports jukebox_fm.jukebox in a fresh interpreter and fails when the
+import takes longer than the budget, or when it pulls in one of the
+heavy dependencies that are meant to be imported lazily.
+
+    python benchmarks/import_time.py --budget-ms 150
+"""
+
+from argparse import ArgumentParser
+from json import loads
+from subprocess import run
+from statistics import median
+import sys
+
+HEAVY = ("yt_dlp", "mpd", "requests", "tqdm")
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import jukebox_fm.jukebox
+elapsed = time.perf_counter() - start
+print(json.dumps({
+    "ms": elapsed * 1000,
+    "loaded": [m for m in %r if m in sys.modules],
+}))
+""" % (HEAVY,)
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--budget-ms", type=float, default=150)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    samples = []
+    loaded = set()
+    for _ in range(args.runs):
+        result = run([sys.executable, "-c", PROBE], capture_output=True, text=True, check=True)
+        probe = loads(result.stdout)
+        samples.append(probe["ms"])
+        loaded.update(probe["loaded"])
+
+    ms = median(samples)
+    print(f"import jukebox_fm.jukebox: {ms:.1f} ms (median of {args.runs}, budget {args.budget_ms:.0f} ms)")
+    failed = False
+    if loaded:
+        print(f"FAIL: imported at startup: {', '.join(sorted(loaded))}")
+        failed = True
+    if ms > args.budget_ms:
+        print("FAIL: over the startup budget")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
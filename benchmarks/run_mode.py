@@ -0,0 +1,39 @@
+"""Run jukebox-fm against the benchmark stand-ins
+
+Started by bench.py in a child process, so that peak RSS is measured
+per mode. Arguments are passed through to jukebox-fm.
+"""
+
+from os import environ, path
+from sys import argv
+import sys
+
+sys.path.insert(0, path.dirname(path.abspath(__file__)))
+
+from jukebox_fm import jukebox
+import stub_ytdlp
+import yt_dlp
+
+
+def configure_ydl_without_ffmpeg(config, music_folder):
+    ydl_opts = configure_ydl(config, music_folder)
+    ydl_opts["postprocessors"] = []
+    ydl_opts.pop("fast_path", None)
+    return ydl_opts
+
+
+base_url = environ["BENCH_LASTFM_URL"]
+jukebox.MPD_HOST = "127.0.0.1"
+jukebox.MPD_PORT = int(environ["BENCH_MPD_PORT"])
+jukebox.STATION_URL = f"{base_url}/player/station"
+jukebox.API_URL = f"{base_url}/2.0/"
+stub_ytdlp.StubYoutubeIE.audio_url = base_url
+# jukebox imports YoutubeDL lazily, so swap it in yt_dlp itself
+yt_dlp.YoutubeDL = stub_ytdlp.BenchYoutubeDL
+
+if environ.get("BENCH_NO_FFMPEG"):
+    configure_ydl = jukebox.configure_ydl
+    jukebox.configure_ydl = configure_ydl_without_ffmpeg
+
+sys.argv = ["jukebox-fm", *argv[1:]]
+jukebox.main()
@@ -0,0 +1,34 @@
+"""yt-dlp stand-in that serves YouTube watch URLs and ytsearch queries
+from the local fake Last.fm server instead of YouTube"""
+
+from hashlib import sha1
+from yt_dlp import YoutubeDL
+from yt_dlp.extractor.common import InfoExtractor
+
+
+class StubYoutubeIE(InfoExtractor):
+    IE_NAME = "stub:youtube"
+    _VALID_URL = r"(?:https?://www\.youtube\.com/watch\?v=(?P<id>[\w-]+)|ytsearch\d*:(?P<query>.+))"
+    audio_url = None
+
+    def _real_extract(self, url):
+        mobj = self._match_valid_url(url)
+        video_id = mobj.group("id") or sha1(mobj.group("query").encode()).hexdigest()[:11]
+        return {
+            "id": video_id,
+            "title": video_id,
+            "url": f"{self.audio_url}/audio/{video_id}.opus",
+            "ext": "opus",
+            "acodec": "opus",
+            "vcodec": "none",
+        }
+
+
+class BenchYoutubeDL(YoutubeDL):
+    """YoutubeDL that tries the stub extractor before the real ones"""
+
+    def __init__(self, params=None, auto_init=True):
+        super().__init__(params, auto_init=False)
+        self.add_info_extractor(StubYoutubeIE())
+        if auto_init:
+            self.add_default_info_extractors()
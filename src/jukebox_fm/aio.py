@@ -0,0 +1,354 @@
+"""asyncio engine for jukebox-fm (--asyncio)
+
+MPD is driven through mpd.asyncio.MPDClient and Last.fm is fetched with
+aiohttp when it is installed, otherwise through the shared requests
+session in worker threads. yt-dlp downloads run on the regular download
+pool, so their blocking work never stalls the event loop and every
+station's lookups, downloads and MPD updates overlap.
+"""
+
+from asyncio import (
+    Lock,
+    Semaphore,
+    TimeoutError,
+    create_task,
+    gather,
+    get_running_loop,
+    run as run_loop,
+    to_thread,
+    wait_for,
+)
+from itertools import islice
+from logging import info, warning, error
+
+from jukebox_fm import jukebox
+from jukebox_fm.jukebox import metrics, log_error
+
+# Tracks read from the source per worker thread hop
+TRACK_BATCH = 50
+
+
+def run(args, config, endpoint, username, music_folder, planned_all=False):
+    run_loop(main(args, config, endpoint, username, music_folder, planned_all))
+
+
+async def main(args, config, endpoint, username, music_folder, planned_all=False):
+    from mpd.asyncio import MPDClient
+
+    mpd = MPDClient()
+    await mpd.connect(jukebox.MPD_HOST, jukebox.MPD_PORT)
+    http = HTTPClient(config)
+    try:
+        ydl_config = jukebox.configure_ydl(config, music_folder)
+
+        if planned_all:
+            # Every track was planned before the interruption, skip Last.fm
+            tracks = []
+        elif args.o:
+            tracks = (
+                (artist, title, None)
+                for artist, title in jukebox.fetch_loved_tracks(username, config)
+            )
+        else:
+            if args.f:
+                _, endpoints = jukebox.friend_endpoints(args, config)
+            elif jukebox.download_mode:
+                _, endpoints = jukebox.album_endpoints(config)
+            else:
+                endpoints = [endpoint]
+            playlists = await gather(*(fetch_station(http, e) for e in endpoints))
+            sources = [
+                jukebox.station_tracks(playlist, config)
+                for playlist in playlists
+                if playlist
+            ]
+            tracks = jukebox.plan_tracks(sources)
+
+        await process_tracks(mpd, tracks, music_folder, ydl_config, config)
+    finally:
+        await http.close()
+        mpd.disconnect()
+
+
+class HTTPClient:
+    """Last.fm client for the event loop, sharing the on-disk response cache
+
+    Uses aiohttp when it is installed and otherwise runs the shared requests
+    session in threads. At most [friends] concurrency requests are in flight.
+    """
+
+    def __init__(self, config=None):
+        self.limit = Semaphore(jukebox.fetch_workers(config))
+        try:
+            from aiohttp import ClientSession, ClientError, TCPConnector
+        except ImportError:
+            info("aiohttp is not installed, fetching Last.fm in threads")
+            from requests import RequestException
+
+            self.session = None
+            self.errors = (RequestException,)
+            return
+        self.session = ClientSession(
+            connector=TCPConnector(limit=jukebox.fetch_workers(config))
+        )
+        # ValueError covers a malformed JSON body, which requests reports as
+        # a RequestException on the threaded path
+        self.errors = (ClientError, TimeoutError, ValueError)
+
+    async def get_json(self, url, params=None, ttl_key=None):
+        async with self.limit:
+            if self.session is None:
+                return await to_thread(jukebox.cached_get_json, url, params, ttl_key)
+
+            data, cache_file = jukebox.cached_response(url, params, ttl_key)
+            if data is not None:
+                return data
+            with metrics.time("lastfm"):
+                async with self.session.get(
+                    url, params=params, raise_for_status=True
+                ) as response:
+                    body = await response.read()
+                    data = await response.json(content_type=None)
+            metrics.count("bytes", len(body), source="lastfm")
+            if cache_file:
+                jukebox.write_cached_response(cache_file, data)
+            return data
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+
+async def fetch_station(http, endpoint):
+    url = f"{jukebox.STATION_URL}/{endpoint}"
+    try:
+        data = await http.get_json(url, ttl_key="station")
+    except http.errors as e:
+        log_error(f"Can't fetch data from LastFM: {e}")
+        return []
+    playlist = data.get("playlist", [])
+    if not playlist:
+        info("No tracks found in the playlist / album.")
+    return playlist
+
+
+async def load_library_index(mpd):
+    """Async counterpart of jukebox.load_library_index, sharing its snapshot"""
+    if jukebox.library_index is not None:
+        return jukebox.library_index
+
+    try:
+        stats = await mpd.stats()
+        snapshot, uri = jukebox.stale_library_snapshot(stats)
+        if uri == "dl":
+            with metrics.time("listallinfo"):
+                try:
+                    dl_cache = await mpd.listallinfo("dl")
+                except Exception:
+                    dl_cache = []
+                snapshot = jukebox.rescanned_library_snapshot(snapshot, stats, "dl", dl_cache)
+            uri = None if snapshot else ""
+        if uri == "":
+            with metrics.time("listallinfo"):
+                library_cache = await mpd.listallinfo()
+                snapshot = jukebox.rescanned_library_snapshot(None, stats, "", library_cache)
+    except Exception as e:
+        warning(f"Could not cache library: {e}")
+        return {}
+
+    jukebox.library_entries = snapshot["entries"]
+    with metrics.time("library_index"):
+        jukebox.library_index = jukebox.build_library_index(jukebox.library_entries)
+    return jukebox.library_index
+
+
+async def add_files(mpd, files):
+    """Add files to the MPD queue, returning (file, error) for the failures
+
+    mpd.asyncio has no command lists, so this is one add per file.
+    """
+    from mpd import CommandError
+
+    failed = []
+    with metrics.time("mpd_add"):
+        for file_path in files:
+            try:
+                await mpd.add(file_path)
+            except CommandError as e:
+                failed.append((file_path, e))
+    return failed
+
+
+async def update_database(mpd, uri):
+    """Start a database update and wait for MPD to finish it"""
+    job = int(await mpd.update(uri))
+    while True:
+        updating = (await mpd.status()).get("updating_db")
+        if updating is None or int(updating) > job:
+            return
+        try:
+            # The update may finish before idle starts listening, so re-check
+            await wait_for(anext(mpd.idle(["update"])), 0.5)
+        except TimeoutError:
+            pass
+
+
+async def evict_downloads(mpd, music_folder, keep=()):
+    """Async counterpart of jukebox.evict_downloads"""
+    from mpd import CommandError
+
+    if not jukebox.music_budget:
+        return
+    if jukebox.download_usage(music_folder)[1] <= jukebox.music_budget:
+        return
+
+    queued = {
+        song["file"].removeprefix("dl/")
+        for song in await mpd.playlistinfo()
+        if song.get("file", "").startswith("dl/")
+    }
+    queued.update(keep)
+    try:
+        stickers = await mpd.sticker_find("song", "dl", jukebox.PLAYED_STICKER)
+    except CommandError:
+        stickers = []
+    for name in jukebox.plan_eviction(music_folder, queued, stickers):
+        await mpd.update(f"dl/{name}")
+
+
+class DownloadQueue:
+    """Batch finished downloads into one database update before queueing
+
+    Downloads finishing while a batch is being queued are picked up
+    together by the next one. keep returns the names eviction must spare,
+    see jukebox.pending_downloads.
+    """
+
+    def __init__(self, mpd, music_folder, keep=set):
+        self.mpd = mpd
+        self.music_folder = music_folder
+        self.keep = keep
+        self.pending = []
+        self.lock = Lock()
+        self.queued = 0
+
+    async def add(self, artist, title, file_path):
+        jukebox.journal_record("downloaded", artist, title)
+        self.pending.append((artist, title, file_path))
+        async with self.lock:
+            if not self.pending:
+                return  # queued by an earlier batch
+            batch, self.pending = self.pending, []
+            files = [file_path for _, _, file_path in batch]
+
+            target = files[0] if len(files) == 1 else "dl"
+            try:
+                with metrics.time("mpd_update"):
+                    await update_database(self.mpd, target)
+            except Exception as e:
+                warning(f"Could not update MPD database for {target}: {e}")
+
+            failed = dict(await add_files(self.mpd, files))
+            for artist, title, file_path in batch:
+                song = jukebox.song_name(file_path)
+                if file_path in failed:
+                    warning(f"Could not queue '{song}': {failed[file_path]}")
+                else:
+                    info(f"Queued: {song}")
+                    jukebox.journal_record("queued", artist, title)
+                    self.queued += 1
+            await evict_downloads(self.mpd, self.music_folder, self.keep())
+
+
+async def track_batches(tracks):
+    """Read a (possibly lazy, blocking) track iterable in a worker thread,
+    one batch at a time"""
+    tracks = iter(tracks)
+    while batch := await to_thread(list, islice(tracks, TRACK_BATCH)):
+        yield batch
+
+
+async def process_tracks(mpd, tracks, music_folder, ydl_config, config=None):
+    """Queue library hits and download the misses concurrently
+
+    Each download is queued as soon as it finishes. tracks may be a
+    generator; like jukebox.process_tracks it is read lazily and stops being
+    read while too many downloads are waiting for a worker.
+
+    Returns:
+        int: Number of tracks added to the MPD queue
+    """
+    index = await load_library_index(mpd)
+    hits = []
+    downloading = set()
+    queue = DownloadQueue(
+        mpd, music_folder, lambda: jukebox.pending_downloads(hits, downloading)
+    )
+    loop = get_running_loop()
+    pool = jukebox.download_pool(config)
+    slots = Semaphore(jukebox.download_workers(config) * 2)
+    downloads = set()
+    hits_queued = 0
+
+    async def download(artist, title, playlink_id):
+        try:
+            file_path = await loop.run_in_executor(
+                pool,
+                jukebox.download_track,
+                artist,
+                title,
+                music_folder,
+                ydl_config,
+                playlink_id,
+            )
+        except Exception as e:
+            error(f"Could not download song '{artist} - {title}': {jukebox.ydl_error_message(e)}")
+            jukebox.journal_record("failed", artist, title)
+            downloading.discard((artist, title))
+            return
+        finally:
+            slots.release()
+        try:
+            await queue.add(artist, title, file_path)
+        finally:
+            downloading.discard((artist, title))
+
+    async def submit(track):
+        await slots.acquire()
+        downloading.add(track[:2])
+        task = create_task(download(*track))
+        downloads.add(task)
+        task.add_done_callback(downloads.discard)
+
+    async def queue_hits(hits):
+        # Queue library hits in one go, download what MPD refused
+        nonlocal hits_queued
+        # Cleared only once queued, so eviction keeps them in the meantime
+        failed = dict(await add_files(mpd, [file_path for _, file_path in hits]))
+        batch = hits[:]
+        hits.clear()
+        for (artist, title, playlink_id), file_path in batch:
+            song_name = f"{artist} - {title}"
+            if file_path in failed:
+                warning(f"Found in library but couldn't queue '{song_name}': {failed[file_path]}")
+                await submit((artist, title, playlink_id))
+            else:
+                info(f"Queued: {song_name}")
+                jukebox.journal_record("queued", artist, title)
+                hits_queued += 1
+
+    async for batch in track_batches(jukebox.journal_tracks(tracks)):
+        for artist, title, playlink_id in batch:
+            file_path = jukebox.is_track_in_library(artist, title, index)
+            metrics.count("tracks", result="library_hit" if file_path else "library_miss")
+            if file_path:
+                hits.append(((artist, title, playlink_id), file_path))
+                continue
+            if slots.locked() and hits:
+                # About to wait for a download, don't keep library hits waiting too
+                await queue_hits(hits)
+            await submit((artist, title, playlink_id))
+        await queue_hits(hits)
+
+    await gather(*downloads)
+    return hits_queued + queue.queued
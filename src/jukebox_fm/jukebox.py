@@ -1,9 +1,18 @@
-from os import path, makedirs, devnull, open as os_open, O_WRONLY, dup, dup2
-from sys import exit, stderr
-from time import sleep
+from os import (
+    path,
+    makedirs,
+    replace,
+    scandir,
+    remove,
+)
+from time import time, perf_counter, monotonic
+from hashlib import sha256
+from tempfile import mkstemp
+from sys import exit
 from argparse import ArgumentParser
 from logging import (
     basicConfig,
+    debug,
     info,
     error,
     warning,
@@ -17,15 +26,107 @@ from logging import (
     CRITICAL,
 )
 from toml import load, dump
-from mpd import MPDClient
-from yt_dlp import YoutubeDL
 from subprocess import run
 from shutil import which
-from requests import get, RequestException
 from importlib import metadata
-from tqdm import tqdm
-
-client = MPDClient()
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, Condition, Event, local
+from contextlib import contextmanager
+from queue import Queue, Empty
+from collections import deque, Counter
+from itertools import islice, chain
+from re import compile as re_compile
+from json import load as json_load, loads as json_loads, dump as json_dump, dumps as json_dumps
+from sqlite3 import connect
+from datetime import datetime
+from select import select
+from unicodedata import normalize, combining
+from random import uniform
+from urllib.parse import urlparse
+
+# mpd, requests, tqdm and yt_dlp are imported where they are used, so that
+# -v, --help and runs served from the library never load yt-dlp
+
+MPD_HOST = "localhost"
+MPD_PORT = 6600
+STATION_URL = "https://www.last.fm/player/station"
+API_URL = "https://ws.audioscrobbler.com/2.0/"
+client = None
+library_index = None
+session = None
+response_cache = None
+library_file = None
+HITS_BATCH = 500
+# Longest a library hit waits for its batch before being queued anyway,
+# checked before each track is pulled from the source
+HITS_FLUSH_SECONDS = 1
+LOVED_PAGE_WORKERS = 4
+COMMAND_LIST_ERROR = re_compile(r"\[\d+@(\d+)\]")
+library_entries = None
+fuzzy_index = None
+fuzzy_threshold = 0.8
+# Bump when the snapshot's entries change shape, older snapshots are rebuilt
+LIBRARY_SNAPSHOT_VERSION = 3
+# Decorations that don't make a different recording: "(Remastered 2011)",
+# "- 2011 Remaster", "feat. X". Only the decoration itself is dropped, so
+# "(Live, Remastered 2011)" still keeps "live": live, acoustic,
+# instrumental, extended and other versions are different recordings.
+FUZZY_NOISE = re_compile(
+    r"\b(?:\d{4}\s+)?(?:digital(?:ly)?\s+)?remaster(?:ed)?(?:\s+(?:version|edition))?(?:\s+\d{4})?\b"
+    r"|\bdeluxe(?:\s+(?:version|edition))?\b|\bexplicit(?:\s+version)?\b"
+)
+# Brackets and " - " suffixes, the only places FUZZY_NOISE is looked for
+FUZZY_BRACKET = re_compile(r"[\(\[]([^\)\]]*)[\)\]]")
+FUZZY_SUFFIX = re_compile(r"\s+-\s+(.*)$")
+# "feat. X" up to the end of its bracket, list item or " - " part
+FUZZY_FEAT = re_compile(r"\b(?:feat\.?|ft\.?|featuring)\s(?:(?!\s-\s)[^\(\)\[\];,/])*")
+NON_WORD = re_compile(r"[^\w]+")
+# Below this similarity a title only matches when it has the same words, so
+# "Yesterdays" or "Love Songs" don't pass for "Yesterday" or "Love Song"
+FUZZY_SAME_WORDS_BELOW = 0.9
+# Numbers that tell tracks apart ("Part 2", "No. 6", "Part II"), which have
+# to be equal for a fuzzy match
+NUMBER_TOKEN = re_compile(r"\b(?:(?:part|pt|no|vol|op|chapter) ([ivx]+)|(\d+|[ivx]{2,}))\b")
+ROMAN_NUMERALS = {"i": 1, "v": 5, "x": 10}
+# Artists sharing a trigram this common are not worth counting
+FUZZY_COMMON_TRIGRAM = 5000
+FUZZY_CANDIDATES = 5
+# Station tracks the daemon remembers having queued, so refills skip them
+DAEMON_MEMORY = 2000
+downloads = None
+scheduler = None
+# Set while the pool shuts down, so retry and rate limit waits end early
+downloads_closing = Event()
+# Longest wait between retries of a throttled download, in seconds
+BACKOFF_CAP = 300
+# Downloads smaller than this finish too fast to tell if they were throttled
+SPEED_SAMPLE_BYTES = 1024 * 1024
+ydl_local = local()
+ydl_instances = []
+ydl_instances_lock = Lock()
+manifest = None
+manifest_lock = Lock()
+manifest_retry = (168 * 3600, 3600)
+search_ttl = 0
+music_budget = 0
+instant_play = False
+journal = None
+journal_lock = Lock()
+journal_pending = []
+journal_done = set()
+# MPD sticker holding when a download was last played, shared with other clients
+PLAYED_STICKER = "lastplayed"
+# yt-dlp errors that won't go away by retrying soon
+PERMANENT_FAILURES = (
+    "video unavailable",
+    "private video",
+    "not available in your country",
+    "blocked",
+    "removed",
+    "copyright",
+    "sign in to confirm your age",
+    "no results on youtube",
+)
 
 
 def main():
@@ -37,6 +138,12 @@ def main():
     # toml
     config = load_config(path.join(config_dir, "config.toml"))
     logger(config, args)
+    global library_file
+    library_file = path.join(config_dir, "library.json")
+    global fuzzy_threshold, music_budget
+    fuzzy_threshold = config.get("library", {}).get("fuzzy_threshold", fuzzy_threshold)
+    music_budget = int(config["music"].get("max_size_mb", 0) * 1024 * 1024)
+    open_manifest(config_dir, config)
     music_folder = path.expanduser(config["music"]["music_folder"])
     username = args.u if args.u else config["lastfm"]["username"]
     mode = args.m if args.m else config["lastfm"]["mode"]
@@ -55,6 +162,16 @@ def main():
         download_mode = True
         info("Loved tracks mode is on")
 
+    global instant_play
+    instant_play = args.stream
+    if args.stream and args.asyncio:
+        error("--stream cannot be used with --asyncio.")
+        exit(1)
+
+    if args.daemon and (args.f or args.o or args.d or args.asyncio or args.resume):
+        error("--daemon only keeps a single station queued, it cannot be used with -f, -o, -d, --asyncio or --resume.")
+        exit(1)
+
     if args.d:
         if not args.b:
             error("Download mode cannot be used without -b.")
@@ -63,54 +180,65 @@ def main():
             download_mode = True
             info("Download mode is on")
 
-    friends = args.f  # friend mode enabled
+    http_session(config)
+    configure_cache(config, config_dir, args)
     endpoint = determine_endpoint(args, username, mode)
+    planned_all = False
+    if not args.daemon:
+        planned_all = open_journal(config_dir, args.resume)
+
+    from mpd import MPDClient
 
     # check if we can connect to the local MPD server
+    global client
+    run_start = perf_counter()
+    finished = False
     try:
-        client.connect("localhost", 6600)
+        if args.asyncio:
+            from jukebox_fm import aio
+
+            aio.run(args, config, endpoint, username, music_folder, planned_all)
+            finished = True
+            return
+
+        client = MPDClient()
+        client.connect(MPD_HOST, MPD_PORT)
         ydl_config = configure_ydl(config, music_folder)
 
-        if args.f:
-            if friends == True:  # -f but no path override
-                friends = path.expanduser(config["friends"]["friends_file"])
-            friends = load_friends(friends)
-            mode = args.m or "library"
-            for username in friends:
-                info(f"fetching: {username}")
-                fetch_lastfm_data(f"user/{username}/{mode}", music_folder, ydl_config, config)
+        if planned_all:
+            # Every track was planned before the interruption, skip Last.fm
+            process_tracks([], music_folder, ydl_config, config)
+
+        elif args.f:
+            friends, endpoints = friend_endpoints(args, config)
+            process_stations(friends, endpoints, music_folder, ydl_config, config)
 
         elif args.o:
             download_loved_tracks(username, music_folder, ydl_config, config)
 
         elif download_mode:
-            max_albums = None
-            if config and "lastfm" in config:
-                max_albums = config["lastfm"].get("max_albums")
-            
-            albums_to_process = albums
-            if max_albums and len(albums) > max_albums:
-                info(f"Limiting to {max_albums} albums (found {len(albums)})")
-                albums_to_process = albums[:max_albums]
-            
-            for i, (name, _) in enumerate(albums_to_process):
-                info(f"{i+1}/{len(albums_to_process)}: {name}")
-                selected_name, _ = albums_to_process[i]
-                selected_url = next(
-                    url for name, url in albums if name == selected_name
-                )
-                endpoint = selected_url.replace("https://www.last.fm/", "")
-                fetch_lastfm_data(endpoint, music_folder, ydl_config, config)
+            names, endpoints = album_endpoints(config)
+            process_stations(names, endpoints, music_folder, ydl_config, config)
+
+        elif args.daemon:
+            run_daemon(endpoint, music_folder, ydl_config, config)
 
         else:
             fetch_lastfm_data(endpoint, music_folder, ydl_config, config)
+        finished = True
 
     except KeyboardInterrupt:
         info("Interrupted by user")
     except Exception as e:
         log_error(e)
     finally:
-        client.disconnect()
+        close_downloads()
+        close_journal(finished)
+        close_manifest()
+        if client is not None:
+            client.disconnect()
+        metrics.observe("run", perf_counter() - run_start)
+        write_stats(config, args)
 
 
 class ColoredFormatter(Formatter):
@@ -134,6 +262,133 @@ class ColoredFormatter(Formatter):
         return result
 
 
+class Metrics:
+    """Timings and counters for the stages of a run
+
+    Timings are kept as histograms per stage, counters are keyed by name
+    and labels, e.g. count("cache", cache="response", result="hit").
+    """
+
+    BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self.lock = Lock()
+        self.stages = {}
+        self.counters = {}
+
+    @contextmanager
+    def time(self, stage):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, perf_counter() - start)
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            hist = self.stages.setdefault(
+                stage,
+                {"count": 0, "sum": 0.0, "max": 0.0, "buckets": [0] * len(self.BUCKETS)},
+            )
+            hist["count"] += 1
+            hist["sum"] += seconds
+            hist["max"] = max(hist["max"], seconds)
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    hist["buckets"][i] += 1
+
+    def count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "stages": {
+                    stage: {
+                        "count": hist["count"],
+                        "sum": round(hist["sum"], 6),
+                        "max": round(hist["max"], 6),
+                        "buckets": dict(zip(map(str, self.BUCKETS), hist["buckets"])),
+                    }
+                    for stage, hist in self.stages.items()
+                },
+                "counters": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in self.counters.items()
+                ],
+            }
+
+    def to_prometheus(self):
+        lines = ["# TYPE jukebox_stage_seconds histogram"]
+        with self.lock:
+            for stage, hist in sorted(self.stages.items()):
+                for bound, n in zip(self.BUCKETS, hist["buckets"]):
+                    lines.append(f'jukebox_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {n}')
+                lines.append(f'jukebox_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {hist["count"]}')
+                lines.append(f'jukebox_stage_seconds_sum{{stage="{stage}"}} {hist["sum"]:.6f}')
+                lines.append(f'jukebox_stage_seconds_count{{stage="{stage}"}} {hist["count"]}')
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f"# TYPE jukebox_{name}_total counter")
+                for (counter, labels), value in sorted(self.counters.items()):
+                    if counter == name:
+                        label_text = ",".join(f'{k}="{v}"' for k, v in labels)
+                        lines.append(f"jukebox_{name}_total{{{label_text}}} {value}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        rows = [("stage", "count", "total s", "mean s", "max s")]
+        with self.lock:
+            for stage, hist in sorted(self.stages.items(), key=lambda x: -x[1]["sum"]):
+                rows.append(
+                    (
+                        stage,
+                        str(hist["count"]),
+                        f"{hist['sum']:.3f}",
+                        f"{hist['sum'] / hist['count']:.3f}",
+                        f"{hist['max']:.3f}",
+                    )
+                )
+            rows.append(("", "", "", "", ""))
+            rows.append(("counter", "value", "", "", ""))
+            for (name, labels), value in sorted(self.counters.items()):
+                label_text = ",".join(f"{k}={v}" for k, v in labels)
+                rows.append((f"{name} {label_text}".strip(), str(value), "", "", ""))
+        widths = [max(len(row[i]) for row in rows) for i in range(5)]
+        return "\n".join(
+            "  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip()
+            for row in rows
+        )
+
+
+metrics = Metrics()
+
+
+def write_stats(config, args):
+    """Write run metrics to [stats] json_file / textfile, print them with --stats"""
+    stats_config = config.get("stats", {}) if config else {}
+    outputs = (
+        (stats_config.get("json_file"), lambda: json_dumps(metrics.to_dict(), indent=2)),
+        (stats_config.get("textfile"), metrics.to_prometheus),
+    )
+    for stats_path, render in outputs:
+        if not stats_path:
+            continue
+        stats_path = path.expanduser(stats_path)
+        tmp_path = f"{stats_path}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                f.write(render())
+            # node_exporter must never read a half-written textfile
+            replace(tmp_path, stats_path)
+        except OSError as e:
+            warning(f"Could not write stats to {stats_path}: {e}")
+
+    if args.stats:
+        print(metrics.summary())
+
+
 def logger(config, args):
     log_file = "/tmp/jukebox-fm.log"
     try:
@@ -178,6 +433,45 @@ def parse_arguments():
         const=True,
         default=None,
     )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Neither read nor write the Last.fm response cache",
+    )
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="Ignore cached Last.fm responses and fetch them again",
+    )
+    parser.add_argument(
+        "--asyncio",
+        action="store_true",
+        help=(
+            "Run stations, MPD and Last.fm requests concurrently on an asyncio "
+            "event loop (install jukebox-fm[asyncio] for aiohttp, otherwise "
+            "Last.fm is fetched in threads)"
+        ),
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Queue YouTube streams of library misses right away, swapping in the downloads when ready",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue an interrupted run from its journal instead of starting over",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="Keep running and refill the MPD queue from the station as it plays",
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="Print per-stage timings and counters at exit",
+    )
     parser.add_argument(
         "-l",
         help="Set logging level (DEBUG, INFO, WARNING, ERROR, CRITICAL)",
@@ -222,13 +516,19 @@ def create_default_config(config_path):
         log_error(f"Could not create configuration directory: {e}")
 
     default_config = {
-        "music": {"music_folder": "~/Music/dl"},
+        "music": {
+            "music_folder": "~/Music/dl",
+            # Disk budget for downloads, the least recently played are
+            # deleted when it is exceeded, 0 for no limit
+            "max_size_mb": 0,
+        },
         "lastfm": {
             "username": "lastfm",
             "mode": "mix",
             "API_KEY": "",  # Get your API key from https://www.last.fm/api/accounts
             # Limits (only used when API_KEY is set)
-            "loved_tracks_limit": 50,  # Max loved tracks to fetch with -o flag
+            "loved_tracks_limit": 50,  # Max loved tracks to fetch with -o flag, 0 for all
+            "loved_tracks_page_size": 200,  # Loved tracks per Last.fm request
             "max_tracks": 50,  # Max tracks to download from playlists/stations
             "max_albums": 10,  # Max albums to download when using -b with -d
         },
@@ -239,12 +539,63 @@ def create_default_config(config_path):
             "preferred_quality": "192",
             "format": "opus/bestaudio",
             "outtmpl": "%(artist)s - %(title)s",
+            # "fast" tags and copies (or transcodes) audio in one ffmpeg run,
+            # "legacy" uses FFmpegExtractAudio followed by FFmpegMetadata
+            "postprocess": "fast",
+            "audio_codec": "opus",
+            # Requests per minute to each YouTube host, 0 for no limit
+            "requests_per_minute": 0,
+            # Retries of a throttled (HTTP 429) or dropped download, waiting
+            # a random time up to backoff_seconds, doubled on every attempt
+            "max_retries": 3,
+            "backoff_seconds": 5,
+            # Streams slower than this many kilobits per second count as
+            # throttled, 0 disables
+            "slow_speed_kbps": 64,
             # Optional path to a cookies.txt (Netscape) file to pass to yt-dlp
             # Example: "~/.config/jukebox-fm/cookies.txt"
             "cookies": "",
         },
-        "friends": {"friends_file": "~/.config/jukebox-fm/friends.txt"},
+        "download": {
+            "workers": 4,  # Parallel yt-dlp downloads
+            # Hours before retrying a video that is blocked, removed or private
+            "failed_retry_hours": 168,
+            # Hours before retrying any other failed download
+            "error_retry_hours": 1,
+            # Days a YouTube search result is reused for, 0 for no expiry
+            "search_ttl_days": 0,
+        },
+        "cache": {
+            # Seconds Last.fm responses are reused for, 0 disables caching
+            "station_ttl": 600,
+            "albums_ttl": 86400,
+            "loved_ttl": 3600,
+            "max_size_mb": 50,
+        },
+        "library": {
+            # Similarity (0-1) needed to treat a near-match such as
+            # "Song (Remastered 2011)" as already owned, 0 disables. Titles
+            # scoring under 0.9 also need the same words
+            "fuzzy_threshold": 0.8,
+        },
+        "friends": {
+            "friends_file": "~/.config/jukebox-fm/friends.txt",
+            "concurrency": 8,  # Friends' stations fetched in parallel
+        },
+        "daemon": {
+            # With --daemon, refill the station when fewer tracks than this
+            # are queued after the current song
+            "prefetch": 10,
+            # Seconds between checks when MPD is idle or a refill failed
+            "poll_seconds": 300,
+        },
         "logging": {"log_file": "/tmp/jukebox-fm.log"},
+        "stats": {
+            # Written at exit when set: run metrics as JSON and as a
+            # node_exporter textfile (e.g. /var/lib/node_exporter/jukebox.prom)
+            "json_file": "",
+            "textfile": "",
+        },
     }
 
     try:
@@ -256,7 +607,9 @@ def create_default_config(config_path):
 
 
 def album(artist_name):
-    url = "https://ws.audioscrobbler.com/2.0/"
+    from requests import RequestException
+
+    url = API_URL
     params = {
         "method": "artist.gettopalbums",
         "artist": artist_name,
@@ -264,17 +617,18 @@ def album(artist_name):
         "format": "json",
     }
 
-    response = get(url, params=params)
-    if response.status_code != 200:
+    try:
+        data = cached_get_json(url, params, "albums")
+    except RequestException:
         log_error("Failed to fetch albums from Last.fm")
         return None
 
-    albums = []
-    for album in response.json().get("topalbums", {}).get("album", []):
+    albums = {}
+    for album in data.get("topalbums", {}).get("album", []):
         album_name = album.get("name", "").strip()
         if album_name and album_name.lower() != "(null)":
             album_url = f"https://www.last.fm/music/{artist_name.replace(' ', '+')}/{album_name.replace(' ', '+')}"
-            albums.append((album_name, album_url))
+            albums.setdefault(album_name, album_url)
 
     if not albums:
         log_error("No valid albums found for this artist.")
@@ -282,7 +636,7 @@ def album(artist_name):
     elif not download_mode:
         fzf_exists = which("fzf") is not None
         if fzf_exists:
-            album_names = [name for name, _ in albums]
+            album_names = list(albums)
             try:
                 info("Launching fzf for album selection...")
                 result = run(
@@ -295,25 +649,19 @@ def album(artist_name):
                 if not selected_name:
                     warning("No album selected.")
                     return None
-                selected_url = next(
-                    url for name, url in albums if name == selected_name
-                )
-                return selected_url
+                return albums[selected_name]
             except Exception as e:
                 error(f"Error running fzf: {e}")
                 return None
         else:
             print("Available Albums:")
-            for i, (name, _) in enumerate(albums):
+            album_names = list(albums)
+            for i, name in enumerate(album_names):
                 print(f"{i}. {name}")
             while True:
                 try:
                     choice = int(input("\nSelect an album (by number): "))
-                    selected_name, _ = albums[choice]
-                    selected_url = next(
-                        url for name, url in albums if name == selected_name
-                    )
-                    return selected_url
+                    return albums[album_names[choice]]
                 except (ValueError, IndexError):
                     print("Invalid selection. Please choose a valid album number.")
     else:
@@ -321,47 +669,87 @@ def album(artist_name):
 
 
 def fetch_loved_tracks(username, config=None):
+    """Yield a user's loved tracks as (artist, title), one page at a time
+
+    The first page tells how many pages there are. The rest are fetched a
+    few at a time in the background and yielded in order, so only a handful
+    of pages are held in memory. [lastfm] loved_tracks_limit caps the number
+    of tracks, 0 fetches all of them.
+    """
+    from requests import RequestException
+
     limit = 50
+    page_size = 200
     if config and "lastfm" in config:
         limit = config["lastfm"].get("loved_tracks_limit", config["lastfm"].get("limit", 50))
-
-    url = "https://ws.audioscrobbler.com/2.0/"
-    params = {
-        "method": "user.getlovedtracks",
-        "user": username,
-        "api_key": api_key,
-        "format": "json",
-        "limit": limit,
-    }
+        page_size = config["lastfm"].get("loved_tracks_page_size", page_size)
+    if limit:
+        page_size = min(page_size, limit)
+
+    url = API_URL
+
+    def fetch_page(page):
+        params = {
+            "method": "user.getlovedtracks",
+            "user": username,
+            "api_key": api_key,
+            "format": "json",
+            "limit": page_size,
+            "page": page,
+        }
+        return cached_get_json(url, params, "loved").get("lovedtracks", {})
 
     try:
-        response = get(url, params=params)
-        response.raise_for_status()
+        loved = fetch_page(1)
+    except RequestException as e:
+        log_error(f"Failed to fetch loved tracks from Last.fm: {e}")
+        return
 
-        data = response.json()
-        loved_tracks = data.get("lovedtracks", {}).get("track", [])
+    total_pages = int(loved.get("@attr", {}).get("totalPages", 1) or 1)
+    if limit:
+        total_pages = min(total_pages, -(-limit // page_size))
 
-        if not loved_tracks:
-            info("No loved tracks found.")
-            return []
+    count = 0
+    pool = ThreadPoolExecutor(LOVED_PAGE_WORKERS)
+    try:
+        pages = iter(range(2, total_pages + 1))
+        in_flight = deque(
+            pool.submit(fetch_page, page) for page in islice(pages, LOVED_PAGE_WORKERS)
+        )
+        while True:
+            loved_tracks = loved.get("track", [])
+            if isinstance(loved_tracks, dict):
+                loved_tracks = [loved_tracks]
 
-        tracks = []
-        for track in loved_tracks:
+            for track in loved_tracks:
+                try:
+                    artist_name = track.get("artist", {}).get("name", "")
+                    track_name = track.get("name", "")
+                    if artist_name and track_name:
+                        info(f"Found loved track: {artist_name} - {track_name}")
+                        yield artist_name, track_name
+                        count += 1
+                        if limit and count >= limit:
+                            return
+                except (TypeError, KeyError) as e:
+                    warning(f"Error parsing loved track data: {e}")
+
+            if not in_flight:
+                break
+            future = in_flight.popleft()
+            for page in islice(pages, 1):
+                in_flight.append(pool.submit(fetch_page, page))
             try:
-                artist_name = track.get("artist", {}).get("name", "")
-                track_name = track.get("name", "")
-                if artist_name and track_name:
-                    tracks.append((artist_name, track_name))
-                    info(f"Found loved track: {artist_name} - {track_name}")
-            except (TypeError, KeyError) as e:
-                warning(f"Error parsing loved track data: {e}")
-
-        info(f"Total loved tracks found: {len(tracks)}")
-        return tracks
-
-    except RequestException as e:
-        log_error(f"Failed to fetch loved tracks from Last.fm: {e}")
-        return []
+                loved = future.result()
+            except RequestException as e:
+                log_error(f"Failed to fetch loved tracks from Last.fm: {e}")
+                break
+    finally:
+        pool.shutdown(cancel_futures=True)
+        if not count:
+            info("No loved tracks found.")
+        else:
+            info(f"Total loved tracks found: {count}")
 
 
 def determine_endpoint(args, username, mode):
@@ -398,6 +786,15 @@ def configure_ydl(config, music_folder):
         ],
     }
 
+    # Fast path: one ffmpeg run that copies or transcodes the audio and tags it
+    if config["yt_dlp"].get("postprocess", "legacy") == "fast":
+        ydl_opts["postprocessors"] = []
+        ydl_opts["fast_path"] = {
+            "codec": config["yt_dlp"].get("audio_codec", "opus"),
+            "quality": config["yt_dlp"]["preferred_quality"],
+        }
+        info(f"Using single-pass postprocessing to {ydl_opts['fast_path']['codec']}")
+
     # If a cookies file is provided in the config, pass it to yt-dlp
     try:
         cookies_path = config.get("yt_dlp", {}).get("cookies", "")
@@ -427,39 +824,41 @@ def configure_ydl(config, music_folder):
 def download_loved_tracks(username, music_folder, ydl_config, config=None):
     """Download all loved tracks for a user"""
     info(f"Fetching loved tracks for user: {username}")
-    loved_tracks = fetch_loved_tracks(username, config)
+    tracks = (
+        (artist, title, None) for artist, title in fetch_loved_tracks(username, config)
+    )
+    process_tracks(tracks, music_folder, ydl_config, config)
 
-    if not loved_tracks:
-        info("No loved tracks to download.")
-        return
+    info("Finished processing loved tracks.")
 
-    info(f"Starting download of {len(loved_tracks)} loved tracks...")
-    
-    try:
-        library_cache = client.listallinfo()
-        info(f"Library cached: {len(library_cache)} items")
-    except Exception as e:
-        warning(f"Could not cache library: {e}")
-        library_cache = []
 
-    for i, (artist, title) in enumerate(loved_tracks, 1):
-        info(f"Processing {i}/{len(loved_tracks)}: {artist} - {title}")
-        song_name = f"{artist} - {title}"
+def friend_endpoints(args, config):
+    """Return the usernames in friends.txt and their station endpoints"""
+    friends = args.f  # friend mode enabled
+    if friends == True:  # -f but no path override
+        friends = path.expanduser(config["friends"]["friends_file"])
+    friends = load_friends(friends) or []
+    mode = args.m or "library"
+    return friends, [f"user/{username}/{mode}" for username in friends]
 
-        # Check if track exists in library and get its file path
-        file_path = is_track_in_library(artist, title, library_cache)
-        if file_path:
-            try:
-                client.add(file_path)
-                info(f"Queued: {song_name}")
-                continue
-            except Exception as e:
-                warning(f"Found in library but couldn't queue '{song_name}': {e}")
 
-        # Search for the track on YouTube and download
-        download_song(artist, title, music_folder, ydl_config, return_success=True)
+def album_endpoints(config):
+    """Return the names and station endpoints of the albums to download,
+    capped at max_albums"""
+    if not albums:
+        return [], []
 
-    info("Finished processing loved tracks.")
+    max_albums = None
+    if config and "lastfm" in config:
+        max_albums = config["lastfm"].get("max_albums")
+
+    names = list(albums)
+    if max_albums and len(names) > max_albums:
+        info(f"Limiting to {max_albums} albums (found {len(names)})")
+        names = names[:max_albums]
+
+    endpoints = [albums[name].replace("https://www.last.fm/", "") for name in names]
+    return names, endpoints
 
 
 def load_friends(friends_file):
@@ -474,55 +873,566 @@ def load_friends(friends_file):
         log_error(f"Could not read friends.txt: {e}")
 
 
-def fetch_lastfm_data(endpoint, music_folder, ydl_config, config=None):
-    url = f"https://www.last.fm/player/station/{endpoint}"
+def http_session(config=None):
+    """Return the shared keep-alive session used for all Last.fm requests"""
+    global session
+    if session is None:
+        from requests import Session
+        from requests.adapters import HTTPAdapter
+
+        session = Session()
+        adapter = HTTPAdapter(pool_maxsize=max(10, fetch_workers(config)))
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+    return session
+
+
+def configure_cache(config, config_dir, args):
+    """Set up the on-disk Last.fm response cache from [cache] and the CLI flags"""
+    global response_cache
+    if args.no_cache:
+        response_cache = None
+        return
+
+    cache_config = config.get("cache", {}) if config else {}
+    response_cache = {
+        "dir": path.join(config_dir, "cache"),
+        "refresh": args.refresh,
+        "ttl": {
+            "station": cache_config.get("station_ttl", 600),
+            "albums": cache_config.get("albums_ttl", 86400),
+            "loved": cache_config.get("loved_ttl", 3600),
+        },
+        "max_bytes": int(cache_config.get("max_size_mb", 50) * 1024 * 1024),
+    }
+
+
+def cache_path(url, params):
+    # The API key doesn't change the response, keep it out of the key
+    params = {k: v for k, v in (params or {}).items() if k != "api_key"}
+    key = sha256(json_dumps([url, params], sort_keys=True).encode()).hexdigest()
+    return path.join(response_cache["dir"], f"{key}.json")
+
+
+def read_cached_response(cache_file, ttl):
+    try:
+        with open(cache_file, "r") as f:
+            entry = json_load(f)
+    except (OSError, ValueError):
+        return None
+    if time() - entry.get("time", 0) > ttl:
+        return None
+    return entry.get("data")
+
+
+def write_cached_response(cache_file, data):
     try:
-        response = get(url)
+        makedirs(response_cache["dir"], exist_ok=True)
+        fd, tmp_path = mkstemp(dir=response_cache["dir"], suffix=".tmp")
+        with open(fd, "w") as f:
+            json_dump({"time": time(), "data": data}, f)
+        replace(tmp_path, cache_file)
+        evict_cached_responses()
+    except OSError as e:
+        warning(f"Could not write response cache: {e}")
+
+
+def evict_cached_responses():
+    """Drop the oldest cached responses until the cache fits in max_size_mb"""
+    entries = []
+    total = 0
+    for entry in scandir(response_cache["dir"]):
+        if entry.name.endswith(".json"):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+
+    for _, size, entry_path in sorted(entries):
+        if total <= response_cache["max_bytes"]:
+            break
+        try:
+            remove(entry_path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def cached_response(url, params=None, ttl_key=None):
+    """Look a request up in the response cache
+
+    Returns:
+        tuple: (cached data or None, file to store a fresh response in or None)
+    """
+    ttl = response_cache["ttl"].get(ttl_key, 0) if response_cache else 0
+    if not ttl:
+        return None, None
+
+    cache_file = cache_path(url, params)
+    if not response_cache["refresh"]:
+        data = read_cached_response(cache_file, ttl)
+        if data is not None:
+            debug(f"Cache hit: {url}")
+            metrics.count("cache", cache="response", result="hit")
+            return data, None
+    metrics.count("cache", cache="response", result="miss")
+    return None, cache_file
+
+
+def cached_get_json(url, params=None, ttl_key=None):
+    """GET a JSON document, served from the response cache while it is fresh
+
+    Raises:
+        RequestException: If the request fails or returns an error status
+    """
+    data, cache_file = cached_response(url, params, ttl_key)
+    if data is not None:
+        return data
+
+    with metrics.time("lastfm"):
+        response = http_session().get(url, params=params)
         response.raise_for_status()
-        playlist = response.json().get("playlist", [])
+        data = response.json()
+    metrics.count("bytes", len(response.content), source="lastfm")
+    if cache_file:
+        write_cached_response(cache_file, data)
+    return data
+
+
+def fetch_workers(config=None):
+    workers = 8
+    if config and "friends" in config:
+        workers = config["friends"].get("concurrency", workers)
+    return max(1, int(workers))
+
+
+def fetch_station(endpoint, ttl_key="station"):
+    """Fetch the playlist of a Last.fm station endpoint"""
+    url = f"{STATION_URL}/{endpoint}"
+    return cached_get_json(url, ttl_key=ttl_key).get("playlist", [])
+
+
+def fetch_stations(endpoints, config=None):
+    """Fetch several stations concurrently, at most [friends] concurrency at once
+
+    Yields:
+        tuple: (endpoint, playlist, error) in the order of endpoints, where
+        error is the RequestException raised for that station, if any
+    """
+    from requests import RequestException
+
+    with ThreadPoolExecutor(fetch_workers(config)) as pool:
+        futures = [pool.submit(fetch_station, endpoint) for endpoint in endpoints]
+        for endpoint, future in zip(endpoints, futures):
+            try:
+                yield endpoint, future.result(), None
+            except RequestException as e:
+                yield endpoint, None, e
+
+
+def station_tracks(playlist, config=None):
+    """Parse a station playlist, capped at [lastfm] max_tracks"""
+    parsed_tracks = parse_tracks(playlist)
+
+    max_tracks = None
+    if config and "lastfm" in config:
+        max_tracks = config["lastfm"].get("max_tracks")
+
+    if max_tracks and len(parsed_tracks) > max_tracks:
+        info(f"Limiting to {max_tracks} tracks (found {len(parsed_tracks)})")
+        parsed_tracks = parsed_tracks[:max_tracks]
+
+    return parsed_tracks
+
+
+def plan_tracks(sources):
+    """Merge the track lists of several sources into one, dropping repeats
 
+    A track is a repeat when its playlink_id or its normalized artist/title
+    was already planned, so every track is looked up and downloaded once.
+    Per-source caps such as max_tracks are applied before planning.
+    """
+    seen_keys = set()
+    seen_ids = set()
+    planned = []
+    total = 0
+    for tracks in sources:
+        for artist, title, playlink_id in tracks:
+            total += 1
+            key = track_key(artist, title)
+            if key in seen_keys or (playlink_id and playlink_id in seen_ids):
+                continue
+            seen_keys.add(key)
+            if playlink_id:
+                seen_ids.add(playlink_id)
+            planned.append((artist, title, playlink_id))
+
+    if total > len(planned):
+        info(f"Skipping {total - len(planned)} duplicate tracks")
+    info(f"Planned: {len(planned)} tracks from {len(sources)} sources")
+    return planned
+
+
+def process_stations(names, endpoints, music_folder, ydl_config, config=None):
+    """Fetch several stations at once and process them as one plan
+
+    All stations share one library lookup and one download queue, so
+    downloads of every station overlap.
+    """
+    sources = []
+    for name, (_, playlist, e) in zip(names, fetch_stations(endpoints, config)):
+        info(f"fetching: {name}")
+        if e:
+            log_error(f"Can't fetch data from LastFM: {e}")
+            continue
         if not playlist:
             info("No tracks found in the playlist / album.")
+            continue
+        sources.append(station_tracks(playlist, config))
+    tracks = plan_tracks(sources)
+    process_tracks(tracks, music_folder, ydl_config, config)
+
+
+def process_station(playlist, music_folder, ydl_config, config=None):
+    if not playlist:
+        info("No tracks found in the playlist / album.")
+        return
+
+    parsed_tracks = station_tracks(playlist, config)
+    info(f"Fetched: {len(parsed_tracks)} tracks")
+    process_tracks(parsed_tracks, music_folder, ydl_config, config)
+
+
+def fetch_lastfm_data(endpoint, music_folder, ydl_config, config=None):
+    from requests import RequestException
+
+    try:
+        playlist = fetch_station(endpoint)
+    except RequestException as e:
+        log_error(f"Can't fetch data from LastFM: {e}")
+        return
+
+    process_station(playlist, music_folder, ydl_config, config)
+
+
+def run_daemon(endpoint, music_folder, ydl_config, config=None):
+    """Keep at least [daemon] prefetch tracks queued after the current song
+
+    Waits for MPD's player and playlist events on the run's connection and
+    refills the queue from the station whenever it runs low. The HTTP
+    session, library index and download pool are kept between refills.
+    """
+    daemon_config = config.get("daemon", {}) if config else {}
+    prefetch = daemon_config.get("prefetch", 10)
+    poll_seconds = daemon_config.get("poll_seconds", 300)
+    queued = {}
+    next_refill = 0
+    info(f"Daemon mode: keeping {prefetch} tracks queued ahead")
+
+    while True:
+        ahead = tracks_ahead()
+        if ahead < prefetch and monotonic() >= next_refill:
+            info(f"{ahead} tracks queued ahead, fetching more")
+            with metrics.time("refill"):
+                refilled = refill_queue(endpoint, queued, music_folder, ydl_config, config)
+            # Don't hammer Last.fm when nothing new could be queued
+            next_refill = 0 if refilled else monotonic() + poll_seconds
+            continue
+        if "player" in wait_for_player(poll_seconds):
+            record_played()
+
+
+def refill_queue(endpoint, queued, music_folder, ydl_config, config=None):
+    """Queue the station's next batch, skipping tracks the daemon queued before
+
+    Returns:
+        bool: Whether any new track made it into the MPD queue
+    """
+    from requests import RequestException
+
+    try:
+        # Always a fresh batch: a cached station would repeat the last one
+        playlist = fetch_station(endpoint, ttl_key=None)
+    except RequestException as e:
+        log_error(f"Can't fetch data from LastFM: {e}")
+        return False
+
+    tracks = []
+    for artist, title, playlink_id in station_tracks(playlist, config):
+        key = track_key(artist, title)
+        if key not in queued:
+            queued[key] = True
+            tracks.append((artist, title, playlink_id))
+    while len(queued) > DAEMON_MEMORY:
+        del queued[next(iter(queued))]
+
+    if not tracks:
+        info("No new tracks in the station")
+        return False
+    info(f"Fetched: {len(tracks)} new tracks")
+    if not process_tracks(tracks, music_folder, ydl_config, config):
+        info("None of the new tracks could be queued")
+        return False
+    return True
+
+
+def download_workers(config=None):
+    workers = 4
+    if config and "download" in config:
+        workers = config["download"].get("workers", workers)
+    return max(1, int(workers))
+
+
+def download_pool(config=None):
+    """Return the download pool, kept for the whole run so that every
+    worker thread holds on to its YoutubeDL instance"""
+    global downloads
+    if downloads is None:
+        downloads_closing.clear()
+        downloads = ThreadPoolExecutor(download_workers(config))
+        download_scheduler(config)
+    return downloads
+
+
+def download_scheduler(config=None):
+    global scheduler
+    if scheduler is None:
+        scheduler = DownloadScheduler(download_workers(config), config)
+    return scheduler
+
+
+class DownloadScheduler:
+    """Adapt the number of parallel downloads to how hard YouTube throttles
+
+    The limit starts at [download] workers. Every clean download raises it
+    by 1/limit and every throttled one (HTTP 429, or a stream slower than
+    [yt_dlp] slow_speed_kbps) halves it, at most once per backoff period.
+    Requests to the same host are spaced by [yt_dlp] requests_per_minute.
+    """
+
+    def __init__(self, workers, config=None):
+        ydl_config = config.get("yt_dlp", {}) if config else {}
+        self.workers = workers
+        self.limit = float(workers)
+        self.active = 0
+        self.condition = Condition()
+        self.retries = ydl_config.get("max_retries", 3)
+        self.backoff = ydl_config.get("backoff_seconds", 5)
+        # kbit/s to bytes/s, the unit of yt-dlp's progress hook
+        self.slow_speed = ydl_config.get("slow_speed_kbps", 64) * 1000 / 8
+        rate = ydl_config.get("requests_per_minute", 0)
+        self.interval = 60 / rate if rate else 0
+        self.next_request = {}
+        self.last_decrease = 0
+
+    @contextmanager
+    def slot(self, host):
+        """Wait for a free download slot and for the host's next request time"""
+        with self.condition:
+            while self.active >= int(self.limit) and not downloads_closing.is_set():
+                self.condition.wait()
+            self.active += 1
+            now = monotonic()
+            start = max(now, self.next_request.get(host, 0))
+            self.next_request[host] = start + self.interval
+        try:
+            if start > now:
+                metrics.observe("rate_limit", start - now)
+                downloads_closing.wait(start - now)
+            if downloads_closing.is_set():
+                raise DownloadsClosed("Downloads were stopped")
+            yield
+        finally:
+            with self.condition:
+                self.active -= 1
+                self.condition.notify_all()
+
+    def finished(self, speed=None):
+        """Report a successful download and its speed in bytes per second"""
+        if speed is not None and speed < self.slow_speed:
+            debug(f"Slow download: {speed * 8 / 1000:.0f} kbps")
+            self.throttled("slow")
             return
+        with self.condition:
+            self.limit = min(self.workers, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+    def throttled(self, signal):
+        metrics.count("throttled", signal=signal)
+        with self.condition:
+            now = monotonic()
+            if now - self.last_decrease < self.backoff or self.limit <= 1:
+                return
+            self.last_decrease = now
+            self.limit = max(1.0, self.limit / 2)
+        warning(f"YouTube is throttling, down to {int(self.limit)} parallel downloads")
+
+    def retry_delay(self, attempt):
+        """Full jitter: a random wait up to backoff_seconds * 2**attempt"""
+        return uniform(0, min(BACKOFF_CAP, self.backoff * 2**attempt))
+
+
+def close_downloads():
+    global downloads
+    downloads_closing.set()
+    if scheduler is not None:
+        with scheduler.condition:
+            scheduler.condition.notify_all()
+    if downloads is not None:
+        downloads.shutdown(cancel_futures=True)
+        downloads = None
+    with ydl_instances_lock:
+        for ydl in ydl_instances:
+            try:
+                ydl.close()
+            except Exception as e:
+                warning(f"Could not close yt-dlp: {e}")
+        ydl_instances.clear()
+
+
+def process_tracks(tracks, music_folder, ydl_config, config=None):
+    """Queue (artist, title, playlink_id) tracks, downloading library misses
 
-        parsed_tracks = parse_tracks(playlist)
+    Library hits are queued straight away while misses are handed to a pool
+    of [download] workers. Each download is queued as soon as it finishes,
+    so playback can start before the rest of the station is ready. A failed
+    download is reported and skipped without stopping the others.
 
-        max_tracks = None
-        if config and "lastfm" in config:
-            max_tracks = config["lastfm"].get("max_tracks")
-        
-        if max_tracks and len(parsed_tracks) > max_tracks:
-            info(f"Limiting to {max_tracks} tracks (found {len(parsed_tracks)})")
-            parsed_tracks = parsed_tracks[:max_tracks]
+    tracks may be a generator; it is consumed lazily and stops being read
+    while too many downloads are waiting for a worker.
+
+    With --stream, a miss is queued as its YouTube stream as soon as a
+    worker has resolved it, and swapped for the file once downloaded.
+    Workers only report to this thread through the finished queue, the
+    MPD connection is never used from a worker.
+
+    Returns:
+        int: Number of tracks added to the MPD queue
+    """
+    index = load_library_index()
+    tracks = journal_tracks(tracks)
+    finished = Queue()
+    queued_count = 0
+    pending = 0
+    max_pending = download_workers(config) * 2
+    stream_ids = {}
+    downloading = set()
+
+    def download(artist, title, playlink_id):
+        def on_stream(url):
+            finished.put(("stream", artist, title, url))
 
-        info(f"Fetched: {len(parsed_tracks)} tracks")
-        
-        # Cache library once at the start
         try:
-            library_cache = client.listallinfo()
-            info(f"Library cached: {len(library_cache)} items")
+            file_path = download_track(
+                artist,
+                title,
+                music_folder,
+                ydl_config,
+                playlink_id,
+                on_stream if instant_play else None,
+            )
+            finished.put(("done", artist, title, file_path))
         except Exception as e:
-            warning(f"Could not cache library: {e}")
-            library_cache = []
-        
-        for artist, title, playlink_id in parsed_tracks:
+            finished.put(("failed", artist, title, e))
+
+    def queue_finished(block, until=0):
+        """Queue every download that has finished as one batch
+
+        Streams resolved in the meantime are queued first.
+        """
+        nonlocal pending, queued_count
+        while pending > until:
+            events = []
+            try:
+                events.append(finished.get(block=block))
+                while True:
+                    events.append(finished.get_nowait())
+            except Empty:
+                pass
+            if not events:
+                return
+
+            downloaded = []
+            for kind, artist, title, value in events:
+                if kind == "stream":
+                    stream_ids[(artist, title)] = queue_stream(artist, title, value)
+                    if stream_ids[(artist, title)]:
+                        queued_count += 1
+                    continue
+                pending -= 1
+                downloading.discard((artist, title))
+                if kind == "failed":
+                    error(f"Could not download song '{artist} - {title}': {ydl_error_message(value)}")
+                    journal_record("failed", artist, title)
+                    stream_ids.pop((artist, title), None)
+                else:
+                    journal_record("downloaded", artist, title)
+                    downloaded.append((artist, title, value))
+            streams = {
+                file_path: stream_ids.pop((artist, title))
+                for artist, title, file_path in downloaded
+                if stream_ids.get((artist, title))
+            }
+            queued = set(queue_songs([file_path for _, _, file_path in downloaded], streams))
+            for artist, title, file_path in downloaded:
+                if file_path in queued:
+                    journal_record("queued", artist, title)
+                    if file_path not in streams:
+                        queued_count += 1
+            if downloaded:
+                evict_downloads(music_folder, pending_downloads(hits, downloading))
+
+    pool = download_pool(config)
+
+    def submit(artist, title, playlink_id):
+        nonlocal pending
+        if pending >= max_pending:
+            # About to wait for a download, don't keep library hits waiting too
+            queue_hits()
+        queue_finished(block=True, until=max_pending - 1)
+        pool.submit(download, artist, title, playlink_id)
+        downloading.add((artist, title))
+        pending += 1
+
+    def queue_hits():
+        # Queue library hits in one command list, download what MPD refused
+        nonlocal hits_since, queued_count
+        batch = hits[:]
+        hits.clear()
+        hits_since = None
+        if not batch:
+            return
+        failed = dict(add_files([file_path for _, file_path in batch]))
+        for (artist, title, playlink_id), file_path in batch:
             song_name = f"{artist} - {title}"
-            
-            # Check if track exists in library cache and get its file path
-            file_path = is_track_in_library(artist, title, library_cache)
-            if file_path:
-                # Queue using the actual file path from library
-                try:
-                    client.add(file_path)
-                    info(f"Queued: {song_name}")
-                except Exception as e:
-                    warning(f"Found in library but couldn't queue '{song_name}': {e}")
-                    download_song(artist, title, music_folder, ydl_config, playlink_id)
+            if file_path in failed:
+                warning(f"Found in library but couldn't queue '{song_name}': {failed[file_path]}")
+                submit(artist, title, playlink_id)
             else:
-                download_song(artist, title, music_folder, ydl_config, playlink_id)
+                info(f"Queued: {song_name}")
+                journal_record("queued", artist, title)
+                queued_count += 1
+
+    hits = []
+    hits_since = None
+    for artist, title, playlink_id in tracks:
+        file_path = is_track_in_library(artist, title, index)
+        metrics.count("tracks", result="library_hit" if file_path else "library_miss")
+        if file_path:
+            hits.append(((artist, title, playlink_id), file_path))
+            if hits_since is None:
+                hits_since = monotonic()
+            if len(hits) >= HITS_BATCH:
+                queue_hits()
+        else:
+            submit(artist, title, playlink_id)
+        if hits and monotonic() - hits_since >= HITS_FLUSH_SECONDS:
+            # Checked before pulling the next track, which may block on a page fetch
+            queue_hits()
+        queue_finished(block=False)
 
-    except RequestException as e:
-        log_error(f"Can't fetch data from LastFM: {e}")
+    queue_hits()
+    queue_finished(block=True)
+    return queued_count
 
 
 def parse_tracks(playlist):
@@ -539,165 +1449,1236 @@ def parse_tracks(playlist):
         except (IndexError, KeyError) as e:
             warning(f"Error parsing track data: {e}")
 
+    remember_video_ids(parsed_tracks)
     return parsed_tracks
 
 
-def is_track_in_library(artist, title, library_cache=None):
+def normalize_tag(value):
+    """Collapse whitespace and casefold a tag value for library lookups"""
+    return " ".join(str(value).split()).casefold()
+
+
+def track_key(artist, title):
+    return normalize_tag(artist), normalize_tag(title)
+
+
+def tag_values(value):
+    """MPD returns repeated tags (e.g. several artists) as a list"""
+    if isinstance(value, list):
+        return value
+    return [value]
+
+
+def index_entries(library_cache):
+    """Flatten listallinfo output into (artist_key, title_key, file,
+    fuzzy artist, fuzzy title) entries
+
+    Songs with several artist/title tags yield an entry for every
+    combination. The fuzzy keys are saved with the snapshot, so the fuzzy
+    index never normalizes the whole library at startup.
+    """
+    entries = []
+    fuzzy_artists = {}
+    for song in library_cache:
+        file_path = song.get("file")
+        if not file_path or "artist" not in song or "title" not in song:
+            continue
+        for artist in tag_values(song["artist"]):
+            if artist not in fuzzy_artists:
+                fuzzy_artists[artist] = fuzzy_normalize(artist, artist=True)
+            for title in tag_values(song["title"]):
+                entries.append(
+                    (
+                        *track_key(artist, title),
+                        file_path,
+                        fuzzy_artists[artist],
+                        fuzzy_normalize(title),
+                    )
+                )
+    return entries
+
+
+def build_library_index(entries):
+    """Build a normalized (artist, title) -> file path index
+
+    The first file seen for a key wins.
+    """
+    index = {}
+    for artist_key, title_key, file_path, *_ in entries:
+        index.setdefault((artist_key, title_key), file_path)
+    return index
+
+
+def count_files(library_cache):
+    return sum(1 for song in library_cache if "file" in song)
+
+
+def read_library_snapshot(snapshot_path):
+    if not snapshot_path or not path.exists(snapshot_path):
+        return None
+    try:
+        with open(snapshot_path, "r") as f:
+            snapshot = json_load(f)
+    except Exception as e:
+        warning(f"Could not read library snapshot: {e}")
+        return None
+    if snapshot.get("version") != LIBRARY_SNAPSHOT_VERSION:
+        info("Library snapshot is from an older version, rebuilding it")
+        return None
+    return snapshot
+
+
+def write_library_snapshot(snapshot_path, snapshot):
+    if not snapshot_path:
+        return
+    tmp_path = f"{snapshot_path}.tmp"
+    try:
+        with open(tmp_path, "w") as f:
+            json_dump(snapshot, f)
+        replace(tmp_path, snapshot_path)
+    except Exception as e:
+        warning(f"Could not write library snapshot: {e}")
+
+
+def full_library_snapshot(library_cache, db_update):
+    info(f"Library cached: {len(library_cache)} items")
+    dl_songs = sum(
+        1 for song in library_cache if song.get("file", "").startswith("dl/")
+    )
+    return {
+        "version": LIBRARY_SNAPSHOT_VERSION,
+        "db_update": db_update,
+        "songs": count_files(library_cache),
+        "dl_songs": dl_songs,
+        "entries": index_entries(library_cache),
+    }
+
+
+def refresh_library_snapshot(snapshot, dl_cache, db_update):
+    """Splice a fresh listing of dl/, where our downloads land, into the snapshot"""
+    entries = [
+        entry for entry in snapshot["entries"] if not entry[2].startswith("dl/")
+    ]
+    entries.extend(index_entries(dl_cache))
+    dl_songs = count_files(dl_cache)
+    info(f"Library refreshed: {dl_songs} items in dl/")
+    return {
+        "version": LIBRARY_SNAPSHOT_VERSION,
+        "db_update": db_update,
+        "songs": snapshot["songs"] - snapshot["dl_songs"] + dl_songs,
+        "dl_songs": dl_songs,
+        "entries": entries,
+    }
+
+
+def stale_library_snapshot(stats):
+    """Compare the saved library snapshot with MPD's stats
+
+    Returns:
+        tuple: (snapshot, uri to list) where uri is None when the snapshot
+        is up to date, "dl" when only downloads need rescanning and "" when
+        the whole library has to be listed
+    """
+    snapshot = read_library_snapshot(library_file)
+    if snapshot and snapshot.get("db_update") == stats.get("db_update"):
+        info(f"Library snapshot is up to date: {snapshot['songs']} items")
+        metrics.count("cache", cache="library", result="hit")
+        return snapshot, None
+    if snapshot:
+        metrics.count("cache", cache="library", result="refresh")
+        return snapshot, "dl"
+    metrics.count("cache", cache="library", result="miss")
+    return None, ""
+
+
+def rescanned_library_snapshot(snapshot, stats, uri, library_cache):
+    """Apply MPD's listallinfo of uri to the snapshot and save the result
+
+    Returns:
+        dict: The new snapshot, or None when the song count no longer adds
+        up after rescanning dl/ and the whole library has to be listed
+    """
+    db_update = stats.get("db_update")
+    if uri:
+        snapshot = refresh_library_snapshot(snapshot, library_cache, db_update)
+        if snapshot["songs"] != int(stats.get("songs", 0)):
+            info("Library changed outside dl/, rescanning")
+            return None
+    else:
+        snapshot = full_library_snapshot(library_cache, db_update)
+    write_library_snapshot(library_file, snapshot)
+    return snapshot
+
+
+def load_library_index():
+    """Return the library index, building it once per run
+
+    The snapshot saved in library_file is reused while MPD's db_update stamp
+    is unchanged. When it changes only dl/ is rescanned, falling back to a
+    full listallinfo if the song count no longer adds up.
+    """
+    global library_index
+    if library_index is not None:
+        return library_index
+
+    try:
+        stats = client.stats()
+        snapshot, uri = stale_library_snapshot(stats)
+        if uri == "dl":
+            with metrics.time("listallinfo"):
+                try:
+                    dl_cache = client.listallinfo("dl")
+                except Exception:
+                    dl_cache = []
+                snapshot = rescanned_library_snapshot(snapshot, stats, "dl", dl_cache)
+            uri = None if snapshot else ""
+        if uri == "":
+            with metrics.time("listallinfo"):
+                snapshot = rescanned_library_snapshot(None, stats, "", client.listallinfo())
+    except Exception as e:
+        warning(f"Could not cache library: {e}")
+        return {}
+
+    global library_entries
+    library_entries = snapshot["entries"]
+    with metrics.time("library_index"):
+        library_index = build_library_index(library_entries)
+    return library_index
+
+
+def is_track_in_library(artist, title, library_index=None):
     """Check if track exists in library and return its file path if found
     
     Returns:
         str or None: File path if found in library, None otherwise
     """
-    if library_cache is None:
+    if not library_index:
         return None
-    
-    for song in library_cache:
-        if "artist" in song and "title" in song and "file" in song:
-            if song["artist"] == artist and song["title"] == title:
-                return song["file"]
-    
+
+    file_path = library_index.get(track_key(artist, title))
+    if file_path or not fuzzy_threshold:
+        return file_path
+
+    global fuzzy_index
+    if not library_entries:
+        return None
+    if fuzzy_index is None or fuzzy_index.entries is not library_entries:
+        with metrics.time("fuzzy_index"):
+            fuzzy_index = FuzzyIndex(library_entries, fuzzy_threshold)
+
+    match = fuzzy_index.lookup(artist, title)
+    if match:
+        file_path, artist_score, title_score = match
+        info(
+            f"Fuzzy match: '{artist} - {title}' -> {file_path} "
+            f"(artist {artist_score:.2f}, title {title_score:.2f})"
+        )
+        metrics.count("fuzzy", result="match")
+        return file_path
+    debug(f"No fuzzy match: '{artist} - {title}'")
+    metrics.count("fuzzy", result="miss")
     return None
 
 
-def queue_song(song, check_only=False):
-    """Queue a song or just check if it can be queued
-    
+def fuzzy_normalize(text, artist=False):
+    """Normalize a tag for fuzzy matching: strip accents, case, punctuation
+    and decorations like "(Remastered 2011)" or "feat. X" """
+    text = normalize("NFKD", str(text))
+    text = "".join(c for c in text if not combining(c)).casefold()
+    text = text.replace("'", "").replace("\u2019", "")
+    text = FUZZY_FEAT.sub(" ", text)
+    text = FUZZY_BRACKET.sub(lambda m: f" {FUZZY_NOISE.sub(' ', m[1])} ", text)
+    text = FUZZY_SUFFIX.sub(lambda m: f" {FUZZY_NOISE.sub(' ', m[1])}", text)
+    text = " ".join(NON_WORD.sub(" ", text).split())
+    if artist and text.startswith("the "):
+        text = text[4:]
+    return text
+
+
+def number_tokens(text):
+    """Numbers in a fuzzy-normalized tag, roman numerals included"""
+    numbers = []
+    for roman, token in NUMBER_TOKEN.findall(text):
+        token = roman or token
+        numbers.append(int(token) if token.isdigit() else roman_value(token))
+    return tuple(numbers)
+
+
+def roman_value(token):
+    total = 0
+    for digit, following in zip(token, token[1:] + " "):
+        value = ROMAN_NUMERALS[digit]
+        total += -value if ROMAN_NUMERALS.get(following, 0) > value else value
+    return total
+
+
+def trigrams(text):
+    padded = f"  {text} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+def dice(a, b):
+    if not a or not b:
+        return 0.0
+    return 2 * len(a & b) / (len(a) + len(b))
+
+
+class FuzzyIndex:
+    """Near-match lookups over the library snapshot's entries
+
+    Artists and titles are normalized with fuzzy_normalize when the
+    snapshot is built. A normalized artist is looked up directly and,
+    failing that, through a trigram index over all artists. Titles are then
+    compared only within the matching artists, so a lookup touches a
+    handful of entries even on libraries with 100k+ tracks. Candidates
+    whose numbers differ ("Part 1" and "Part 2") never match, and titles
+    scoring under FUZZY_SAME_WORDS_BELOW need the same words.
+    """
+
+    def __init__(self, entries, threshold):
+        self.entries = entries
+        self.threshold = threshold
+        self.titles = {}
+        for _, _, file_path, artist, title in entries:
+            self.titles.setdefault(artist, {}).setdefault(title, file_path)
+
+        self.artists = list(self.titles)
+        self.artist_grams = [trigrams(artist) for artist in self.artists]
+        self.postings = {}
+        for i, grams in enumerate(self.artist_grams):
+            for gram in grams:
+                self.postings.setdefault(gram, []).append(i)
+        # Title trigrams are computed per artist on first use
+        self.title_grams = {}
+
+    def artist_candidates(self, artist):
+        if artist in self.titles:
+            return [(artist, 1.0)]
+
+        grams = trigrams(artist)
+        numbers = number_tokens(artist)
+        shared = Counter()
+        for gram in grams:
+            posting = self.postings.get(gram, ())
+            if len(posting) <= FUZZY_COMMON_TRIGRAM:
+                shared.update(posting)
+
+        candidates = []
+        for i, _ in shared.most_common(FUZZY_CANDIDATES):
+            if number_tokens(self.artists[i]) != numbers:
+                continue
+            score = dice(grams, self.artist_grams[i])
+            if score >= self.threshold:
+                candidates.append((self.artists[i], score))
+        return candidates
+
+    def lookup(self, artist, title):
+        """Return (file, artist score, title score) for the best match, or None"""
+        title = fuzzy_normalize(title)
+        grams = trigrams(title)
+        numbers = number_tokens(title)
+        words = set(title.split())
+        best = None
+        for candidate, artist_score in self.artist_candidates(fuzzy_normalize(artist, artist=True)):
+            titles = self.titles[candidate]
+            if title in titles:
+                return titles[title], artist_score, 1.0
+
+            if candidate not in self.title_grams:
+                self.title_grams[candidate] = [
+                    (trigrams(t), number_tokens(t), set(t.split()), file_path)
+                    for t, file_path in titles.items()
+                ]
+            for title_grams, title_numbers, title_words, file_path in self.title_grams[candidate]:
+                if title_numbers != numbers:
+                    continue
+                score = dice(grams, title_grams)
+                if score < FUZZY_SAME_WORDS_BELOW and title_words != words:
+                    continue
+                if score >= self.threshold and (best is None or score > best[2]):
+                    best = (file_path, artist_score, score)
+        return best
+
+
+def wait_for_update(job):
+    """Block until MPD has finished the database update with the given job id"""
+    while True:
+        updating = client.status().get("updating_db")
+        if updating is None or int(updating) > job:
+            return
+        client.idle("update")
+
+
+def tracks_ahead():
+    """Number of tracks in the MPD queue after the current song"""
+    status = client.status()
+    length = int(status.get("playlistlength", 0))
+    if "song" not in status:
+        return length
+    return length - int(status["song"]) - 1
+
+
+def wait_for_player(timeout):
+    """Block until the player or the queue changes, or timeout seconds pass"""
+    client.send_idle("player", "playlist")
+    ready, _, _ = select([client], [], [], timeout)
+    if ready:
+        return client.fetch_idle()
+    return client.noidle()
+
+
+def update_database(uri):
+    job = client.update(uri)
+    wait_for_update(int(job))
+
+
+def queue_songs(files, streams=None):
+    """Rescan MPD's database once for a batch of downloaded files, then queue them
+
+    A single file only rescans itself, a batch rescans dl/ once. Files in
+    streams replace their queued stream (a song id) instead of being
+    appended.
+
     Args:
-        song: Song name in format "Artist - Title"
-        check_only: If True, only check if file exists without queuing
-    
+        files: MPD paths of the downloads, as returned by download_track
+
     Returns:
-        bool: True if song exists and can be queued, False otherwise
+        list: Files that were queued, counting streamed ones
     """
+    if not files:
+        return []
+    streams = streams or {}
+
+    target = files[0] if len(files) == 1 else "dl"
     try:
-        client.update("dl")
-        sleep(0.1)
-        
-        if check_only:
-            # Just check if the file exists in MPD's database
-            try:
-                result = client.search("filename", f"dl/{song}.opus")
-                return len(result) > 0
-            except:
-                return False
-        
-        client.add(f"dl/{song}.opus")
-        info(f"Queued: {song}")
-        return True
+        with metrics.time("mpd_update"):
+            update_database(target)
     except Exception as e:
-        # Only log if we were actually trying to queue (not just checking)
-        if not check_only:
-            warning(f"Could not queue '{song}': {e}")
-        return False
+        warning(f"Could not update MPD database for {target}: {e}")
+
+    failed = dict(add_files([file_path for file_path in files if file_path not in streams]))
+    queued = []
+    for file_path in files:
+        if file_path in streams:
+            swap_stream(file_path, streams[file_path])
+            queued.append(file_path)
+        elif file_path in failed:
+            warning(f"Could not queue '{song_name(file_path)}': {failed[file_path]}")
+        else:
+            info(f"Queued: {song_name(file_path)}")
+            queued.append(file_path)
+    return queued
 
 
-def download_song(
-    artist, title, music_folder, ydl_config, playlink_id=None, return_success=False
-):
+def song_name(file_path):
+    """"Artist - Title" of a downloaded file"""
+    return path.splitext(path.basename(file_path))[0]
+
+
+def download_uri(file_path):
+    """MPD path of a file in music_folder, which MPD sees as dl/"""
+    return f"dl/{path.basename(file_path)}"
+
+
+def queue_stream(artist, title, url):
+    """Queue a stream URL tagged as the track
+
+    Returns:
+        str: The stream's song id, or None if MPD refused it
+    """
+    from mpd import CommandError
+
+    song = f"{artist} - {title}"
+    try:
+        song_id = client.addid(url)
+    except CommandError as e:
+        warning(f"Could not queue the stream of '{song}': {e}")
+        return None
+    try:
+        client.command_list_ok_begin()
+        client.addtagid(song_id, "artist", artist)
+        client.addtagid(song_id, "title", title)
+        client.command_list_end()
+    except CommandError:
+        pass  # MPD before 0.19 can't tag queue entries
+    info(f"Streaming: {song}")
+    metrics.count("tracks", result="streamed")
+    return song_id
+
+
+def swap_stream(file_path, stream_id):
+    """Replace a queued stream with its downloaded file, at the same position
+
+    A stream that is playing is left to finish, and one that was removed
+    from the queue isn't replaced.
     """
-    Download a song using yt-dlp and queue it in MPD.
+    from mpd import CommandError
+
+    song = song_name(file_path)
+    try:
+        entry = client.playlistid(stream_id)
+    except CommandError:
+        info(f"Stream of '{song}' was removed from the queue, not queueing the download")
+        return
+    if client.status().get("songid") == str(stream_id):
+        info(f"Downloaded: {song} (its stream is playing, keeping it)")
+        return
+
+    try:
+        client.command_list_ok_begin()
+        client.addid(file_path, entry[0]["pos"])
+        client.deleteid(stream_id)
+        client.command_list_end()
+    except CommandError as e:
+        warning(f"Could not replace the stream of '{song}': {e}")
+        return
+    info(f"Queued: {song} (replacing its stream)")
+
+
+def add_files(files):
+    """Add many files to the MPD queue in one command list round trip
+
+    MPD stops a command list at the first failing command and reports its
+    position, so the rest of the batch is resent after the bad path.
+
+    Returns:
+        list: (file, error) pairs for the files that could not be queued
+    """
+    from mpd import CommandError
+
+    failed = []
+    remaining = list(files)
+    while remaining:
+        client.command_list_ok_begin()
+        for file_path in remaining:
+            client.add(file_path)
+        try:
+            with metrics.time("mpd_add"):
+                client.command_list_end()
+            return failed
+        except CommandError as e:
+            match = COMMAND_LIST_ERROR.search(str(e))
+            if not match:
+                # Unknown position, retrying could queue songs twice
+                failed.extend((file_path, e) for file_path in remaining)
+                return failed
+            position = int(match.group(1))
+            failed.append((remaining[position], e))
+            remaining = remaining[position + 1 :]
+    return failed
+
+
+def record_played():
+    """Remember when the current song started playing if it is a download
+
+    Stored in the lastplayed sticker when MPD has a sticker database, and
+    in the manifest either way.
+    """
+    from mpd import CommandError
+
+    uri = client.currentsong().get("file", "")
+    if not uri.startswith("dl/"):
+        return
+    now = time()
+    try:
+        client.sticker_set("song", uri, PLAYED_STICKER, int(now))
+    except CommandError:
+        pass  # no sticker database
+    manifest_record_play(path.basename(uri), now)
+
+
+def evict_downloads(music_folder, keep=()):
+    """Delete the least recently played downloads over [music] max_size_mb
+
+    Songs in the MPD queue or in keep (see pending_downloads) are kept. Only
+    the deleted files are rescanned.
+    """
+    from mpd import CommandError
+
+    if not music_budget or download_usage(music_folder)[1] <= music_budget:
+        return
+
+    queued = {
+        path.basename(song["file"])
+        for song in client.playlistinfo()
+        if song.get("file", "").startswith("dl/")
+    }
+    queued.update(keep)
+    try:
+        stickers = client.sticker_find("song", "dl", PLAYED_STICKER)
+    except CommandError:
+        stickers = []
+    evicted = plan_eviction(music_folder, queued, stickers)
+    if not evicted:
+        return
+
+    client.command_list_ok_begin()
+    for name in evicted:
+        client.update(f"dl/{name}")
+    client.command_list_end()
+
+
+def pending_downloads(hits, downloading):
+    """Names that eviction must keep while process_tracks is still queueing
 
     Args:
-        artist: Artist name
-        title: Song title
-        music_folder: Folder to download to
-        ydl_config: yt-dlp configuration
-        playlink_id: YouTube video ID (if None, will search YouTube)
-        return_success: If True, returns success boolean instead of just logging
+        hits: ((artist, title, playlink_id), MPD path) library hits not
+            queued yet
+        downloading: (artist, title) of downloads not queued yet, which
+            may already be on disk (a manifest hit, or a stream whose file
+            is about to replace it)
 
     Returns:
-        bool: Success status if return_success=True, otherwise None
+        set: File names of the dl/ hits and "Artist - Title" stems of the
+            downloads
     """
-    song = f"{artist} - {title}"
+    keep = {path.basename(file_path) for _, file_path in hits if file_path.startswith("dl/")}
+    keep.update(f"{artist} - {title}" for artist, title in downloading)
+    return keep
 
-    # Progress bar setup
-    pbar = None
-    
-    def progress_hook(d):
-        nonlocal pbar
-        if d['status'] == 'downloading':
-            if pbar is None:
-                total = d.get('total_bytes') or d.get('total_bytes_estimate', 0)
-                pbar = tqdm(total=total, unit='B', unit_scale=True, desc=f"⬇ {song[:50]}", leave=False)
-            downloaded = d.get('downloaded_bytes', 0)
-            if pbar.total and downloaded <= pbar.total:
-                pbar.n = downloaded
-                pbar.refresh()
-        elif d['status'] == 'finished':
-            if pbar:
-                pbar.close()
-                pbar = None
 
-    # Determine download URL/search
-    if playlink_id:
-        url_or_search = f"https://www.youtube.com/watch?v={playlink_id}"
-        ydl_opts = {**ydl_config}
-    else:
-        url_or_search = f"{artist} {title}"
-        ydl_opts = {**ydl_config, "default_search": "ytsearch1:"}
+def download_usage(music_folder):
+    """Return the finished downloads as {name: (size, mtime, atime)} and their total size"""
+    files = {}
+    try:
+        for entry in scandir(music_folder):
+            if entry.is_file() and not entry.name.endswith((".part", ".ytdl")) and ".temp." not in entry.name:
+                stat = entry.stat()
+                files[entry.name] = (stat.st_size, stat.st_mtime, stat.st_atime)
+    except FileNotFoundError:
+        pass
+    return files, sum(size for size, _, _ in files.values())
+
 
+def plan_eviction(music_folder, queued, stickers):
+    """Delete downloads, least recently played first, until they fit the budget
+
+    When a file was last played is the latest of its lastplayed sticker,
+    its manifest play record, and its access and modification times.
+
+    Args:
+        queued: Names of files, or their "Artist - Title" stems, that are
+            never deleted
+        stickers: Result of MPD's sticker find for the lastplayed sticker
+
+    Returns:
+        list: Names of the deleted files
+    """
+    files, total = download_usage(music_folder)
+    played = manifest_plays()
+    for entry in stickers:
+        name = path.basename(entry.get("file", ""))
+        try:
+            when = float(str(entry.get("sticker", "")).partition("=")[2])
+        except ValueError:
+            continue
+        played[name] = max(played.get(name, 0), when)
+
+    def last_used(name):
+        _, mtime, atime = files[name]
+        return max(played.get(name, 0), mtime, atime)
+
+    evicted = []
+    freed = 0
+    for name in sorted(files, key=last_used):
+        if total - freed <= music_budget:
+            break
+        if name in queued or path.splitext(name)[0] in queued:
+            continue
+        try:
+            remove(path.join(music_folder, name))
+        except OSError as e:
+            warning(f"Could not delete {name}: {e}")
+            continue
+        freed += files[name][0]
+        evicted.append(name)
+        debug(f"Evicted: {name}")
+
+    if evicted:
+        forget_downloads(evicted)
+        metrics.count("evicted", len(evicted))
+        info(
+            f"Deleted {len(evicted)} least recently played downloads "
+            f"({freed / 1024 / 1024:.0f} MB) to stay under {music_budget / 1024 / 1024:.0f} MB"
+        )
+    if total - freed > music_budget:
+        warning("Downloads are over max_size_mb, but the rest are in the MPD queue")
+    return evicted
+
+
+def forget_downloads(names):
+    """Drop deleted downloads from the library index and its fuzzy entries"""
+    global library_entries
+    if not library_index:
+        return
+    uris = {f"dl/{name}" for name in names}
+    for key in [key for key, uri in library_index.items() if uri in uris]:
+        del library_index[key]
+    if library_entries:
+        library_entries = [entry for entry in library_entries if entry[2] not in uris]
+
+
+class YdlLogger:
+    """Send yt-dlp output to the log file instead of the terminal
+
+    Download errors are raised and reported per track, so everything is
+    logged at debug level here.
+    """
+
+    def debug(self, msg):
+        debug(f"yt-dlp: {msg}")
+
+    def info(self, msg):
+        debug(f"yt-dlp: {msg}")
+
+    def warning(self, msg):
+        debug(f"yt-dlp: {msg}")
+
+    def error(self, msg):
+        debug(f"yt-dlp: {msg}")
+
+
+def ydl_progress_hook(d):
+    """Progress bar for the song the current worker thread is downloading"""
+    from tqdm import tqdm
+
+    pbar = getattr(ydl_local, "pbar", None)
+    if d['status'] == 'downloading':
+        if pbar is None:
+            total = d.get('total_bytes') or d.get('total_bytes_estimate', 0)
+            pbar = tqdm(
+                total=total,
+                unit='B',
+                unit_scale=True,
+                desc=f"⬇ {ydl_local.song[:50]}",
+                leave=False,
+                position=ydl_local.position,
+            )
+            ydl_local.pbar = pbar
+        downloaded = d.get('downloaded_bytes', 0)
+        if pbar.total and downloaded <= pbar.total:
+            pbar.n = downloaded
+            pbar.refresh()
+    elif d['status'] == 'finished':
+        close_progress_bar()
+        size = d.get('downloaded_bytes') or d.get('total_bytes') or 0
+        if d.get('elapsed') is not None:
+            metrics.observe("download", d['elapsed'])
+            if size >= SPEED_SAMPLE_BYTES and d['elapsed'] > 0:
+                ydl_local.speed = size / d['elapsed']
+        metrics.count("bytes", size, source="youtube")
+
+
+def ydl_postprocessor_hook(d):
+    """Time each postprocessor (ffmpeg run) of the current download"""
+    if d['status'] == 'started':
+        ydl_local.pp_start = perf_counter()
+    elif d['status'] == 'finished' and getattr(ydl_local, "pp_start", None):
+        metrics.observe("postprocess", perf_counter() - ydl_local.pp_start)
+        ydl_local.pp_start = None
+
+
+def close_progress_bar():
+    pbar = getattr(ydl_local, "pbar", None)
+    if pbar:
+        pbar.close()
+        ydl_local.pbar = None
+
+
+def worker_ydl(music_folder, ydl_config):
+    """Return the YoutubeDL instance of the calling thread, creating it once
+
+    Per-track names and tags come from the info dict, so the instance (its
+    extractors, options and cookie jar) is reused for every download.
+    """
+    ydl = getattr(ydl_local, "ydl", None)
+    if ydl is not None and ydl_local.key == (music_folder, id(ydl_config)):
+        return ydl
+
+    ydl_opts = {
+        key: value for key, value in ydl_config.items() if key != "fast_path"
+    }
     ydl_opts.update(
         {
-            "postprocessor_args": [
-                "-metadata",
-                f"title={title}",
-                "-metadata",
-                f"artist={artist}",
-            ],
-            "outtmpl": path.join(music_folder, f"{artist} - {title}"),
+            "outtmpl": path.join(music_folder, "%(artist)s - %(title)s.%(ext)s"),
+            "logger": YdlLogger(),
             "no_warnings": True,
             "ignoreerrors": False,
-            "progress_hooks": [progress_hook],
+            "progress_hooks": [ydl_progress_hook],
+            "postprocessor_hooks": [ydl_postprocessor_hook],
             "quiet": True,
             "no_color": True,
+            # Keep .part files and pick them up again after an interruption
+            "continuedl": True,
         }
     )
+    from yt_dlp import YoutubeDL
+    from jukebox_fm.postprocess import FFmpegAudioTagPP
 
-    try:
-        # Temporarily redirect stderr to suppress yt-dlp error messages
-        stderr_fd = stderr.fileno()
-        old_stderr = dup(stderr_fd)
-        devnull_fd = os_open(devnull, O_WRONLY)
-        
-        try:
-            dup2(devnull_fd, stderr_fd)
-            with YoutubeDL(ydl_opts) as ydl:
-                ydl.download([url_or_search])
-        finally:
-            # Restore stderr
-            dup2(old_stderr, stderr_fd)
-            makedirs  # Keep import
-        
-        # Ensure progress bar is closed
-        if pbar:
-            pbar.close()
+    ydl = YoutubeDL(ydl_opts)
+    if "fast_path" in ydl_config:
+        ydl.add_post_processor(FFmpegAudioTagPP(ydl, **ydl_config["fast_path"]))
+    with ydl_instances_lock:
+        # One terminal line per worker, so concurrent progress bars don't mix
+        ydl_local.position = len(ydl_instances)
+        ydl_instances.append(ydl)
+    ydl_local.ydl = ydl
+    ydl_local.key = (music_folder, id(ydl_config))
+    return ydl
 
-        # Queue the song
-        queue_success = queue_song(song)
 
-        if return_success:
-            if queue_success:
-                info(f"Downloaded and queued: {song}")
-                return True
-            else:
-                warning(f"Downloaded but failed to queue: {song}")
-                return False
+def ydl_error_message(e):
+    # Extract just the core error message, skip yt-dlp prefix
+    error_msg = str(e)
+    if error_msg.startswith("ERROR: "):
+        error_msg = error_msg[7:]  # Remove "ERROR: " prefix
+    return error_msg
+
+
+def open_journal(config_dir, resume=False):
+    """Open the run journal, an append-only log of every planned track's state
+
+    A run that finishes removes it. With resume, tracks an interrupted run
+    left unfinished are planned first and finished ones are skipped.
+
+    Returns:
+        bool: Whether the interrupted run had planned all its tracks
+    """
+    global journal
+    journal_file = path.join(config_dir, "journal.jsonl")
+    planned_all = False
+    if resume:
+        planned_all = read_journal(journal_file)
+        if journal_pending or journal_done:
+            info(
+                f"Resuming: {len(journal_pending)} unfinished tracks, "
+                f"{len(journal_done)} already done"
+            )
         else:
+            warning("Nothing to resume, starting over")
+    try:
+        journal = open(journal_file, "a" if resume else "w")
+        if resume:
+            journal.write("\n")  # end a torn last line
+    except OSError as e:
+        warning(f"Could not open resume journal: {e}")
+        journal = None
+    return planned_all
+
+
+def read_journal(journal_file):
+    """Load an interrupted run's journal into journal_pending and journal_done
+
+    Torn lines, from a crash mid-write, are skipped.
+    """
+    global journal_pending
+    pending = {}
+    planned_all = False
+    try:
+        with open(journal_file, "r") as f:
+            for line in f:
+                try:
+                    entry = json_loads(line)
+                except ValueError:
+                    continue
+                state = entry["state"]
+                if state == "planned_all":
+                    planned_all = True
+                    continue
+                artist, title, playlink_id = entry["track"]
+                key = manifest_key(artist, title)
+                if state == "planned" and key not in journal_done:
+                    pending[key] = (artist, title, playlink_id)
+                elif state in ("queued", "failed"):
+                    pending.pop(key, None)
+                    journal_done.add(key)
+    except FileNotFoundError:
+        pass
+    journal_pending = list(pending.values())
+    return planned_all
+
+
+def journal_record(state, artist=None, title=None, playlink_id=None):
+    if journal is None:
+        return
+    entry = {"state": state}
+    if artist is not None:
+        entry["track"] = [artist, title, playlink_id]
+    with journal_lock:
+        journal.write(json_dumps(entry) + "\n")
+        journal.flush()
+
+
+def journal_tracks(tracks):
+    """Journal tracks as they are planned
+
+    A resumed run's unfinished tracks come first, and tracks it already
+    queued or gave up on are skipped.
+    """
+    global journal_pending
+    if journal is None:
+        yield from tracks
+        return
+
+    pending, journal_pending = journal_pending, []
+    seen = set()
+    for artist, title, playlink_id in chain(pending, tracks):
+        key = manifest_key(artist, title)
+        if key in journal_done or key in seen:
+            continue
+        seen.add(key)
+        journal_record("planned", artist, title, playlink_id)
+        yield artist, title, playlink_id
+    journal_record("planned_all")
+
+
+def close_journal(finished):
+    """Close the journal, deleting it when the run finished"""
+    global journal
+    if journal is None:
+        return
+    journal.close()
+    if finished:
+        try:
+            remove(journal.name)
+        except FileNotFoundError:
             pass
+    else:
+        info("Run with --resume to continue where this run stopped")
+    journal = None
+
+
+class KnownFailure(Exception):
+    """The manifest says this track failed recently, don't try it again yet"""
+
+
+class DownloadsClosed(Exception):
+    """The download pool is shutting down, the track was not attempted"""
 
+
+def open_manifest(config_dir, config=None):
+    """Open the download manifest, which remembers the outcome of every download
+
+    Each row maps a normalized artist/title (and the YouTube ID it came
+    from) to the downloaded file, or to the reason it failed and when to
+    retry it.
+    """
+    global manifest, manifest_retry, search_ttl
+    download_config = config.get("download", {}) if config else {}
+    manifest_retry = (
+        download_config.get("failed_retry_hours", 168) * 3600,
+        download_config.get("error_retry_hours", 1) * 3600,
+    )
+    search_ttl = download_config.get("search_ttl_days", 0) * 86400
+    try:
+        manifest = connect(
+            path.join(config_dir, "manifest.db"), check_same_thread=False
+        )
+        manifest.execute(
+            """CREATE TABLE IF NOT EXISTS downloads (
+                track_key TEXT PRIMARY KEY,
+                playlink_id TEXT,
+                file TEXT,
+                status TEXT NOT NULL,
+                reason TEXT,
+                retry_after REAL,
+                updated REAL NOT NULL
+            )"""
+        )
+        manifest.execute(
+            "CREATE INDEX IF NOT EXISTS downloads_playlink_id ON downloads (playlink_id)"
+        )
+        manifest.execute(
+            "CREATE TABLE IF NOT EXISTS plays (name TEXT PRIMARY KEY, last_played REAL NOT NULL)"
+        )
+        manifest.execute(
+            """CREATE TABLE IF NOT EXISTS searches (
+                track_key TEXT PRIMARY KEY,
+                video_id TEXT NOT NULL,
+                updated REAL NOT NULL
+            )"""
+        )
+        manifest.commit()
     except Exception as e:
-        # Extract just the core error message, skip yt-dlp prefix
-        error_msg = str(e)
-        if error_msg.startswith("ERROR: "):
-            error_msg = error_msg[7:]  # Remove "ERROR: " prefix
-        
-        if return_success:
-            warning(f"Could not download '{song}': {error_msg}")
-            return False
-        else:
-            error(f"Could not download song '{song}': {error_msg}")
+        warning(f"Could not open download manifest: {e}")
+        manifest = None
+
+
+def close_manifest():
+    global manifest
+    if manifest is not None:
+        manifest.close()
+        manifest = None
+
+
+def manifest_key(artist, title):
+    return "\t".join(track_key(artist, title))
+
+
+def manifest_lookup(artist, title, playlink_id=None):
+    """Return the latest manifest row for a track as a dict, or None"""
+    if manifest is None:
+        return None
+    with manifest_lock:
+        row = manifest.execute(
+            """SELECT file, status, reason, retry_after FROM downloads
+            WHERE track_key = ? OR (? IS NOT NULL AND playlink_id = ?)
+            ORDER BY updated DESC LIMIT 1""",
+            (manifest_key(artist, title), playlink_id, playlink_id),
+        ).fetchone()
+    if row is None:
+        return None
+    return dict(zip(("file", "status", "reason", "retry_after"), row))
+
+
+def manifest_record(artist, title, playlink_id, status, file_path=None, reason=None):
+    if manifest is None:
+        return
+    retry_after = None
+    if status == "failed":
+        permanent = any(p in reason.lower() for p in PERMANENT_FAILURES)
+        retry_after = time() + manifest_retry[0 if permanent else 1]
+    with manifest_lock:
+        manifest.execute(
+            "INSERT OR REPLACE INTO downloads VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                manifest_key(artist, title),
+                playlink_id,
+                file_path,
+                status,
+                reason,
+                retry_after,
+                time(),
+            ),
+        )
+        manifest.commit()
+
+
+def remember_video_ids(tracks):
+    """Cache the YouTube IDs of (artist, title, video_id) tracks, so later
+    downloads of the same track skip the ytsearch1 lookup"""
+    if manifest is None:
+        return
+    rows = [
+        (manifest_key(artist, title), video_id, time())
+        for artist, title, video_id in tracks
+        if video_id
+    ]
+    if not rows:
+        return
+    with manifest_lock:
+        manifest.executemany("INSERT OR REPLACE INTO searches VALUES (?, ?, ?)", rows)
+        manifest.commit()
+
+
+def cached_video_id(artist, title):
+    """Return the cached YouTube ID of a track, or None when unknown or older
+    than [download] search_ttl_days"""
+    if manifest is None:
+        return None
+    oldest = time() - search_ttl if search_ttl else 0
+    with manifest_lock:
+        row = manifest.execute(
+            "SELECT video_id FROM searches WHERE track_key = ? AND updated >= ?",
+            (manifest_key(artist, title), oldest),
+        ).fetchone()
+    metrics.count("cache", cache="search", result="hit" if row else "miss")
+    return row[0] if row else None
+
+
+def forget_video_id(artist, title):
+    if manifest is None:
+        return
+    with manifest_lock:
+        manifest.execute(
+            "DELETE FROM searches WHERE track_key = ?", (manifest_key(artist, title),)
+        )
+        manifest.commit()
+
+
+def manifest_record_play(name, when):
+    if manifest is None:
+        return
+    with manifest_lock:
+        manifest.execute("INSERT OR REPLACE INTO plays VALUES (?, ?)", (name, when))
+        manifest.commit()
+
+
+def manifest_plays():
+    """Return {downloaded file name: when it was last played}"""
+    if manifest is None:
+        return {}
+    with manifest_lock:
+        return dict(manifest.execute("SELECT name, last_played FROM plays"))
+
+
+def failure_cause(reason):
+    """Bucket a yt-dlp error message for the failures counter"""
+    reason = reason.lower()
+    if "429" in reason or "too many requests" in reason or "not a bot" in reason:
+        return "throttled"
+    if any(p in reason for p in PERMANENT_FAILURES):
+        return "unavailable"
+    if "ffmpeg" in reason or "postprocessing" in reason:
+        return "postprocess"
+    if "timed out" in reason or "connection" in reason:
+        return "network"
+    return "other"
+
+
+def download_track(
+    artist, title, music_folder, ydl_config, playlink_id=None, on_stream=None
+):
+    """
+    Download a song using yt-dlp without queueing it.
+
+    The manifest is checked first: songs downloaded before are returned
+    without touching the network and recent failures are not retried.
+
+    Args:
+        artist: Artist name
+        title: Song title
+        music_folder: Folder to download to
+        ydl_config: yt-dlp configuration
+        playlink_id: YouTube video ID (if None, the cached search result
+            is used, or YouTube is searched, also when the cached video
+            is no longer available)
+        on_stream: Called once with the audio stream URL before downloading
+
+    Returns:
+        str: MPD path of the downloaded file, e.g. "dl/Artist - Title.opus"
+
+    Raises:
+        KnownFailure: If the track failed recently
+        DownloadsClosed: If the pool was closed before the track was tried
+        Exception: Whatever yt-dlp raised when the download failed, after
+            retrying throttled and network errors
+    """
+    song = f"{artist} - {title}"
+    scheduler = download_scheduler()
+    searched = not playlink_id
+    if searched:
+        playlink_id = cached_video_id(artist, title)
+    known = manifest_lookup(artist, title, playlink_id)
+    if known and known["status"] == "ok" and path.exists(known["file"]):
+        debug(f"Already downloaded: {song}")
+        metrics.count("cache", cache="manifest", result="hit")
+        return download_uri(known["file"])
+    if known and known["status"] == "failed" and known["retry_after"] > time():
+        retry_at = datetime.fromtimestamp(known["retry_after"]).strftime("%Y-%m-%d %H:%M")
+        metrics.count("failures", cause="known_failure")
+        raise KnownFailure(f"{known['reason']} (skipped until {retry_at})")
+    metrics.count("cache", cache="manifest", result="miss")
+
+    stream_url = None
+
+    def stream_once(url):
+        # Retries resolve the stream again, it is only queued once
+        nonlocal stream_url
+        if stream_url is None:
+            stream_url = url
+            on_stream(url)
+
+    attempt = 0
+    while True:
+        try:
+            file_path, video_id = run_ydl(
+                artist,
+                title,
+                music_folder,
+                ydl_config,
+                playlink_id,
+                stream_once if on_stream else None,
+            )
+            break
+        except Exception as e:
+            if downloads_closing.is_set():
+                # Stopped by close_downloads, not a failure of this track
+                raise
+            reason = ydl_error_message(e)
+            cause = failure_cause(reason)
+            metrics.count("failures", cause=cause)
+            if cause == "throttled":
+                scheduler.throttled("429")
+            if cause in ("throttled", "network") and attempt < scheduler.retries:
+                delay = scheduler.retry_delay(attempt)
+                attempt += 1
+                warning(f"Retrying '{song}' in {delay:.1f}s ({attempt}/{scheduler.retries}): {reason}")
+                if downloads_closing.wait(delay):
+                    raise
+                continue
+            if searched and playlink_id and cause == "unavailable":
+                # The cached video is gone, search YouTube instead
+                info(f"Cached video for '{song}' is unavailable, searching again")
+                forget_video_id(artist, title)
+                playlink_id = None
+                attempt = 0
+                continue
+            manifest_record(artist, title, playlink_id, "failed", reason=reason)
+            raise
+
+    scheduler.finished(getattr(ydl_local, "speed", None))
+    if searched:
+        remember_video_ids([(artist, title, video_id)])
+    manifest_record(artist, title, video_id, "ok", file_path=file_path)
+    return download_uri(file_path)
+
+
+def run_ydl(artist, title, music_folder, ydl_config, playlink_id=None, on_stream=None):
+    """Download and tag a song with this thread's YoutubeDL
+
+    on_stream, if given, gets the selected format's URL before the download
+    starts.
+
+    Returns:
+        tuple: (path of the downloaded file, YouTube video ID)
+    """
+    song = f"{artist} - {title}"
+    ydl = worker_ydl(music_folder, ydl_config)
+    ydl_local.song = song
+    ydl_local.speed = None
+
+    # Determine download URL/search
+    if playlink_id:
+        url_or_search = f"https://www.youtube.com/watch?v={playlink_id}"
+    else:
+        url_or_search = f"ytsearch1:{artist} {title}"
+
+    host = urlparse(url_or_search).hostname or "www.youtube.com"
+    try:
+        with download_scheduler().slot(host):
+            with metrics.time("extract"):
+                info_dict = ydl.extract_info(url_or_search, download=False)
+            if info_dict.get("_type") == "playlist":
+                entries = info_dict.get("entries") or []
+                if not entries:
+                    raise LookupError(f"No results on YouTube for '{song}'")
+                info_dict = entries[0]
+            if on_stream and info_dict.get("url"):
+                on_stream(info_dict["url"])
+
+            # Name the file after the track and tag it through FFmpegMetadata
+            info_dict.update(
+                {
+                    "artist": artist,
+                    "title": title,
+                    "meta_artist": artist,
+                    "meta_title": title,
+                }
+            )
+            result = ydl.process_ie_result(info_dict, download=True)
+    finally:
+        # Ensure progress bar is closed
+        close_progress_bar()
+
+    requested = result.get("requested_downloads") or [{}]
+    file_path = requested[0].get("filepath")
+    if not file_path:
+        from jukebox_fm.postprocess import ENCODERS
 
-    return None if not return_success else False
+        codec = ydl_config.get("fast_path", {}).get("codec", "opus")
+        file_path = path.join(music_folder, f"{song}.{ENCODERS.get(codec, (None, 'opus'))[1]}")
+    return file_path, info_dict.get("id", playlink_id)
 
 
 def log_error(message):
@@ -0,0 +1,67 @@
+from os import cpu_count, replace
+from threading import BoundedSemaphore
+from yt_dlp.postprocessor.ffmpeg import FFmpegPostProcessor
+from yt_dlp.utils import prepend_extension, replace_extension
+
+# ffmpeg encoder and file extension for each target codec
+ENCODERS = {
+    "opus": ("libopus", "opus"),
+    "vorbis": ("libvorbis", "ogg"),
+    "mp3": ("libmp3lame", "mp3"),
+    "aac": ("aac", "m4a"),
+    "flac": ("flac", "flac"),
+}
+
+# Encoding is CPU bound, so no more ffmpeg encoders than cores at once
+transcode_slots = BoundedSemaphore(cpu_count() or 1)
+
+
+class FFmpegAudioTagPP(FFmpegPostProcessor):
+    """Extract the audio stream and write its tags in a single ffmpeg run
+
+    Replaces FFmpegExtractAudio + FFmpegMetadata. When the downloaded codec
+    already is the target codec the stream is copied, otherwise it is
+    transcoded once. Tags come from the meta_title and meta_artist fields.
+    """
+
+    def __init__(self, downloader=None, codec="opus", quality="192"):
+        super().__init__(downloader)
+        self.codec = codec
+        self.quality = str(quality)
+
+    def run(self, info):
+        source = info["filepath"]
+        encoder, ext = ENCODERS[self.codec]
+        target = replace_extension(source, ext, info.get("ext"))
+        out_path = prepend_extension(target, "temp") if target == source else target
+
+        options = ["-vn"]
+        source_codec = self.get_audio_codec(source)
+        copy = source_codec == self.codec
+        if copy:
+            options += ["-acodec", "copy"]
+        else:
+            options += ["-acodec", encoder]
+            if float(self.quality) < 10:
+                options += ["-q:a", self.quality]  # VBR quality like yt-dlp
+            else:
+                options += ["-b:a", f"{self.quality}k"]
+
+        for tag in ("title", "artist"):
+            value = info.get(f"meta_{tag}")
+            if value:
+                options += ["-metadata", f"{tag}={value}"]
+
+        if copy:
+            self.to_screen(f"Remuxing {source_codec} audio into {out_path}")
+            self.run_ffmpeg(source, out_path, options)
+        else:
+            self.to_screen(f"Transcoding {source_codec} audio into {out_path}")
+            with transcode_slots:
+                self.run_ffmpeg(source, out_path, options)
+
+        if out_path != target:
+            replace(out_path, target)
+        info["filepath"] = target
+        info["ext"] = ext
+        return ([] if target == source else [source]), info